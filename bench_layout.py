@@ -0,0 +1,166 @@
+#~ this script compares the 'standard' and 'compact' layouts of bib_data
+#~ ([local_db] layout in config.ini): the same synthetic bibs are synced
+#~ into a scratch local database in each layout, and the file size and
+#~ the time of some typical scans of bib_data are reported. No sierra
+#~ connection is needed.
+#~
+#~ usage: python bench_layout.py [number of bibs]
+
+import configparser
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+import get_bibs
+
+
+class BenchApp(get_bibs.App):
+	"""
+
+	an App that syncs synthetic bibs into a scratch local database, in
+	the given layout
+
+	"""
+
+	def __init__(self, path, layout, count):
+		config = configparser.ConfigParser()
+		config['db'] = {
+			'connection_string': '',
+			'itersize': '5000'
+		}
+		config['local_db'] = {
+			'connection_string': path,
+			'layout': layout
+		}
+		self.count = count
+		super().__init__(config)
+
+
+	def get_sierra_rows(self, deleted=False):
+		#~ (the rows have to be a generator, which fill_local_db closes)
+		if deleted == False:
+			return 0, gen_values(self.count)
+		else:
+			return 0, gen_values(0)
+
+
+def gen_values(count):
+	#~ rows like the ones from the sierra query, with a spread of codes
+	#~ and dates
+	languages = ('eng', 'spa', 'fre', 'ger', 'chi', 'jpn', 'rus', 'ita')
+	countries = ('xxu', 'onc', 'enk', 'nyu', 'cau', 'fr ', 'sp ', 'gw ')
+	materials = ('a', 'g', 'j', 'z', '2', 'i', 'c')
+	for i in range(count):
+		created = date(2000, 1, 1) + timedelta(days=i % 6000)
+		yield (
+			420907795456 + i,
+			1000000 + i,
+			created + timedelta(days=100),
+			1527080425.351 + i,
+			created,
+			None,
+			None,
+			created + timedelta(days=3),
+			'Synthetic title number {} : a benchmark record'.format(i),
+			'Author, Synthetic {}, author.'.format(i % 5000),
+			1900 + i % 120,
+			'm',
+			materials[i % len(materials)],
+			languages[i % len(languages)],
+			countries[i % len(countries)],
+			'ocm{:08d}'.format(i),
+			i % 3 != 0,
+			'{:09d}'.format(i)
+		)
+
+
+#~ the scans timed for each layout (through the bib_data view for the 
+#~ compact one), and the last one written for each: grouping the 
+#~ compact layout on the code ids, and only then looking up the codes
+scans = (
+	('count by material_code', "SELECT material_code, COUNT(*) FROM bib_data GROUP BY 1"),
+	('count by language_code', "SELECT language_code, COUNT(*) FROM bib_data GROUP BY 1"),
+	('count by publish_year', "SELECT publish_year, COUNT(*) FROM bib_data GROUP BY 1"),
+	('oclc coverage', "SELECT control_num_035_is_oclc, COUNT(*) FROM bib_data GROUP BY 1"),
+	('created by year', "SELECT substr(creation_date, 1, 4), COUNT(*) FROM bib_data GROUP BY 1"),
+	('every column', "SELECT * FROM bib_data")
+)
+
+layout_scans = {
+	'standard': ('material_code by code id', "SELECT material_code, COUNT(*) FROM bib_data GROUP BY 1"),
+	'compact': ('material_code by code id', """
+		SELECT
+		c.code,
+		counts.bibs
+
+		FROM (
+			SELECT
+			material_code_id,
+			COUNT(*) as bibs
+
+			FROM
+			bib_data_compact
+
+			GROUP BY
+			1
+		) as counts
+
+		LEFT OUTER JOIN
+		bib_codes as c
+		ON
+		  c.code_id = counts.material_code_id
+		""")
+}
+
+
+def bench(layout, count):
+	path = 'bench_layout_{}.db'.format(layout)
+	if os.path.exists(path):
+		os.remove(path)
+
+	app = BenchApp(path, layout, count)
+	start = time.perf_counter()
+	app.sync_live()
+	load_seconds = time.perf_counter() - start
+	app.sqlite_conn.execute("VACUUM")
+
+	results = [('load', load_seconds)]
+	cursor = app.sqlite_conn.cursor()
+	for name, sql in scans + (layout_scans[layout], ):
+		#~ best of three
+		best = None
+		for i in range(3):
+			start = time.perf_counter()
+			cursor.execute(sql)
+			cursor.fetchall()
+			elapsed = time.perf_counter() - start
+			if best is None or elapsed < best:
+				best = elapsed
+		results.append((name, best))
+	cursor.close()
+
+	size = app.get_local_size()
+	app.close_connections()
+	os.remove(path)
+
+	return size, results
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		count = int(sys.argv[1])
+	else:
+		count = 200000
+
+	sizes = {}
+	timings = {}
+	for layout in ('standard', 'compact'):
+		sizes[layout], timings[layout] = bench(layout, count)
+
+	print('')
+	print('bibs: {}'.format(count))
+	print('{:<26}{:>14}{:>14}'.format('', 'standard', 'compact'))
+	print('{:<26}{:>14.1f}{:>14.1f}'.format('file size (MB)', sizes['standard'] / 1024 / 1024, sizes['compact'] / 1024 / 1024))
+	for (name, standard), (name, compact) in zip(timings['standard'], timings['compact']):
+		print('{:<26}{:>13.3f}s{:>13.3f}s'.format(name, standard, compact))
@@ -0,0 +1,124 @@
+#~ this script compares the cost of the two row paths of get_bibs
+#~ ('dict' and 'tuple' row_mode): the time it takes to convert a row
+#~ from sierra into the values for the local insert, and the memory
+#~ held by a batch of fetched rows. No database connection is needed.
+#~
+#~ usage: python bench_rows.py [number of rows]
+
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from datetime import date
+
+import psycopg2.extras
+
+import get_bibs
+
+
+class BenchApp(get_bibs.App):
+	"""
+
+	an App that only holds the settings the row converters look at,
+	without reading config.ini or opening any connections
+
+	"""
+
+	def __init__(self, row_mode, deleted_mode='merge'):
+		self.sqlite_conn = None
+		self.pgsql_conn = None
+		self.pgsql_pool = None
+		self.row_mode = row_mode
+		self.deleted_mode = deleted_mode
+		self.extract_mode = 'cursor'
+
+
+class DescriptionCursor:
+	"""
+
+	just enough of a cursor for psycopg2.extras.DictRow to be made from
+
+	"""
+
+	def __init__(self, columns):
+		self.index = OrderedDict((name, i) for i, name in enumerate(columns))
+		self.description = columns
+
+
+def gen_values(count):
+	#~ a typical row from the sierra query
+	for i in range(count):
+		yield (
+			420907795456 + i,
+			1000000 + i,
+			date(2018, 5, 23),
+			1527080425.351 + i,
+			date(2015, 1, 19),
+			None,
+			None,
+			date(2015, 1, 19),
+			'Dogwood Hill [electronic resource]',
+			'Woods, Sherryl, author.',
+			2015,
+			'm',
+			'2',
+			'eng',
+			'onc',
+			'|aovd84EB6AB7-71B7-47C2-8AC5-847A6B209530',
+			True,
+			'{:09d}'.format(i)
+		)
+
+
+def make_rows(row_mode, count):
+	if row_mode == 'tuple':
+		return list(gen_values(count))
+
+	cursor = DescriptionCursor(get_bibs.App.sierra_columns)
+	rows = []
+	for values in gen_values(count):
+		row = psycopg2.extras.DictRow(cursor)
+		row[:] = values
+		rows.append(row)
+
+	return rows
+
+
+def bench(row_mode, deleted, count):
+	app = BenchApp(row_mode)
+
+	tracemalloc.start()
+	rows = make_rows(row_mode, count)
+	rows_memory = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+
+	convert = app.get_row_converter(deleted)
+
+	#~ best of three
+	best = None
+	for i in range(3):
+		start = time.perf_counter()
+		for row in rows:
+			convert(row)
+		elapsed = time.perf_counter() - start
+		if best is None or elapsed < best:
+			best = elapsed
+
+	print('{}\tdeleted: {}\t{:.3f} us/row\t{:.0f} bytes/row'.format(
+		row_mode,
+		deleted,
+		best / count * 1000000,
+		rows_memory / count
+	))
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		count = int(sys.argv[1])
+	else:
+		count = 100000
+
+	print('rows: {}'.format(count))
+	for deleted in (False, True):
+		for row_mode in ('dict', 'tuple'):
+			bench(row_mode, deleted, count)
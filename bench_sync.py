@@ -0,0 +1,503 @@
+#~ this script benchmarks get_bibs end to end. It fills a scratch
+#~ postgresql database (never the sierra server) with synthetic
+#~ sierra_view tables -- record_metadata, bib_record_property,
+#~ bib_record and varfield -- and then times the extraction and the
+#~ full and incremental runs of fill_local_db into a scratch local
+#~ database, reporting rows / sec, peak RSS and the local file size.
+#~ Before that, it checks that the join and subquery query modes fetch
+#~ the same rows.
+#~
+#~ the sync is run with the settings from the [db] and [local_db]
+#~ sections of config.ini, so modes can be compared by changing them;
+#~ the benchmark's own settings are in the [bench] section.
+#~
+#~ usage: python bench_sync.py
+
+import configparser
+import os
+import sys
+import time
+
+import psycopg2
+
+import get_bibs
+
+
+def get_bench_config():
+	"""
+
+	return the config for the benchmark: config.ini, with the sierra and
+	local connections pointed at the scratch databases from [bench]
+
+	"""
+
+	config = configparser.ConfigParser()
+	config.read('config.ini')
+
+	if 'bench' not in config:
+		sys.exit('no [bench] section in config.ini')
+
+	bench = config['bench']
+	if bench['connection_string'] == config['db']['connection_string']:
+		sys.exit('the [bench] connection_string must be a scratch database, not sierra')
+
+	config['db']['connection_string'] = bench['connection_string']
+	config['local_db']['connection_string'] = bench.get('local_db', 'bench.db')
+
+	return config
+
+
+def create_sierra_view(conn, bench):
+	"""
+
+	(re)create the sierra_view tables, filled with synthetic bibs (and
+	some item records, so the filter on record type has something to
+	leave out)
+
+	"""
+
+	params = {
+		'bibs': int(bench.get('bibs', 100000)),
+		'varfields': int(bench.get('varfields_per_bib', 4)),
+		'deleted': float(bench.get('deleted_fraction', 0.05))
+	}
+
+	with conn:
+		with conn.cursor() as cursor:
+			#~ only ever drop a sierra_view that the benchmark made
+			cursor.execute("""
+			SELECT
+			EXISTS(SELECT 1 FROM information_schema.schemata WHERE schema_name = 'sierra_view'),
+			EXISTS(SELECT 1 FROM information_schema.tables WHERE table_schema = 'sierra_view' AND table_name = 'bench_marker')
+			""")
+			schema_exists, marker_exists = cursor.fetchone()
+			if schema_exists and not marker_exists:
+				sys.exit('sierra_view already exists in the [bench] database, and was not made by the benchmark')
+
+			cursor.execute("""
+			DROP SCHEMA IF EXISTS sierra_view CASCADE;
+			CREATE SCHEMA sierra_view;
+			CREATE TABLE sierra_view.bench_marker (created timestamptz DEFAULT now());
+			INSERT INTO sierra_view.bench_marker DEFAULT VALUES;
+
+			CREATE TABLE sierra_view.record_metadata (
+				id bigint PRIMARY KEY,
+				record_type_code char(1),
+				record_num integer,
+				campus_code varchar(9),
+				creation_date_gmt timestamptz,
+				deletion_date_gmt date,
+				record_last_updated_gmt timestamptz
+			);
+
+			CREATE TABLE sierra_view.bib_record (
+				id bigserial PRIMARY KEY,
+				record_id bigint,
+				language_code varchar(3),
+				country_code varchar(3),
+				cataloging_date_gmt timestamptz
+			);
+
+			CREATE TABLE sierra_view.bib_record_property (
+				id bigserial PRIMARY KEY,
+				bib_record_id bigint,
+				best_title varchar(1000),
+				best_author varchar(1000),
+				publish_year integer,
+				bib_level_code char(1),
+				material_code char(1)
+			);
+
+			CREATE TABLE sierra_view.varfield (
+				id bigserial PRIMARY KEY,
+				record_id bigint,
+				varfield_type_code char(1),
+				marc_tag varchar(3),
+				occ_num integer,
+				field_content varchar(20001)
+			);
+			""")
+
+			cursor.execute("""
+			INSERT INTO
+			sierra_view.record_metadata
+
+			SELECT
+			420907795456 + n,
+			'b',
+			n,
+			'',
+			timestamptz '2000-01-01' + n * interval '37 seconds',
+			CASE
+				WHEN random() < %(deleted)s
+				THEN date '2015-01-01' + (n %% 1000)
+				ELSE NULL
+			END,
+			timestamptz '2010-01-01' + random() * interval '3000 days'
+
+			FROM
+			generate_series(1, %(bibs)s) as n;
+
+			INSERT INTO
+			sierra_view.record_metadata
+
+			SELECT
+			450971566080 + n,
+			'i',
+			n,
+			'',
+			timestamptz '2000-01-01' + n * interval '37 seconds',
+			NULL,
+			timestamptz '2010-01-01' + random() * interval '3000 days'
+
+			FROM
+			generate_series(1, %(bibs)s / 2) as n;
+
+			INSERT INTO
+			sierra_view.bib_record (
+				record_id,
+				language_code,
+				country_code,
+				cataloging_date_gmt
+			)
+
+			SELECT
+			r.id,
+			(ARRAY['eng', 'spa', 'fre', 'ger', 'chi'])[1 + r.record_num %% 5],
+			(ARRAY['xxu', 'onc', 'enk', 'sp ', 'fr '])[1 + r.record_num %% 5],
+			r.creation_date_gmt + interval '3 days'
+
+			FROM
+			sierra_view.record_metadata as r
+
+			WHERE
+			r.record_type_code = 'b';
+
+			INSERT INTO
+			sierra_view.bib_record_property (
+				bib_record_id,
+				best_title,
+				best_author,
+				publish_year,
+				bib_level_code,
+				material_code
+			)
+
+			SELECT
+			r.id,
+			'Synthetic title number ' || r.record_num || ' : a benchmark record',
+			'Author, Synthetic ' || (r.record_num %% 5000) || ', author.',
+			1900 + r.record_num %% 120,
+			'm',
+			(ARRAY['a', 'g', 'j', 'z', '2'])[1 + r.record_num %% 5]
+
+			FROM
+			sierra_view.record_metadata as r
+
+			WHERE
+			r.record_type_code = 'b';
+
+			-- the control numbers: an 001 for every bib, an 035 (most of
+			-- them oclc numbers) for most, and a second 035 for some
+			INSERT INTO
+			sierra_view.varfield (
+				record_id,
+				varfield_type_code,
+				marc_tag,
+				occ_num,
+				field_content
+			)
+
+			SELECT
+			r.id,
+			'o',
+			'001',
+			0,
+			'ocm' || lpad(r.record_num::text, 8, '0')
+
+			FROM
+			sierra_view.record_metadata as r
+
+			WHERE
+			r.record_type_code = 'b'
+
+			UNION ALL
+
+			SELECT
+			r.id,
+			'o',
+			'035',
+			0,
+			CASE
+				WHEN r.record_num %% 3 = 0
+				THEN '|a(Sirsi) a' || r.record_num
+				ELSE '|a(OCoLC)' || (10000000 + r.record_num)
+			END
+
+			FROM
+			sierra_view.record_metadata as r
+
+			WHERE
+			r.record_type_code = 'b'
+			AND r.record_num %% 10 <> 0
+
+			UNION ALL
+
+			SELECT
+			r.id,
+			'o',
+			'035',
+			1,
+			'|a(OCoLC)99999999'
+
+			FROM
+			sierra_view.record_metadata as r
+
+			WHERE
+			r.record_type_code = 'b'
+			AND r.record_num %% 4 = 0;
+
+			-- and the rest of the varfields
+			INSERT INTO
+			sierra_view.varfield (
+				record_id,
+				varfield_type_code,
+				marc_tag,
+				occ_num,
+				field_content
+			)
+
+			SELECT
+			r.id,
+			'n',
+			'500',
+			f,
+			'|aSynthetic note ' || f || ' for record ' || r.record_num
+
+			FROM
+			sierra_view.record_metadata as r
+
+			CROSS JOIN
+			generate_series(0, %(varfields)s - 1) as f
+
+			WHERE
+			r.record_type_code = 'b';
+
+			CREATE INDEX ON sierra_view.varfield (record_id);
+			CREATE INDEX ON sierra_view.record_metadata (record_last_updated_gmt);
+			CREATE INDEX ON sierra_view.record_metadata (deletion_date_gmt);
+			CREATE INDEX ON sierra_view.bib_record (record_id);
+			CREATE INDEX ON sierra_view.bib_record_property (bib_record_id);
+			""", params)
+
+	#~ ANALYZE can't run inside of the transaction
+	conn.autocommit = True
+	with conn.cursor() as cursor:
+		cursor.execute("ANALYZE")
+	conn.autocommit = False
+
+
+def update_sierra_view(conn, bench):
+	"""
+
+	update and delete some of the bibs, the way a day of cataloging
+	would, for the incremental runs
+
+	"""
+
+	params = {
+		'updated': float(bench.get('updated_fraction', 0.01)),
+		'deleted': float(bench.get('newly_deleted_fraction', 0.002))
+	}
+
+	with conn:
+		with conn.cursor() as cursor:
+			cursor.execute("""
+			UPDATE
+			sierra_view.record_metadata
+
+			SET
+			record_last_updated_gmt = now()
+
+			WHERE
+			record_type_code = 'b'
+			AND deletion_date_gmt IS NULL
+			AND random() < %(updated)s;
+
+			UPDATE
+			sierra_view.record_metadata
+
+			SET
+			deletion_date_gmt = current_date,
+			record_last_updated_gmt = now()
+
+			WHERE
+			record_type_code = 'b'
+			AND deletion_date_gmt IS NULL
+			AND random() < %(deleted)s;
+			""", params)
+
+
+def get_local_db_size(path):
+	size = 0
+	for suffix in ('', '-wal'):
+		if os.path.exists(path + suffix):
+			size += os.path.getsize(path + suffix)
+
+	return size
+
+
+def report(phase, rows_fetched, rows_written, seconds, peak_rss_mb, local_size):
+	print('{:<28}{:>10}{:>10}{:>10.2f}{:>12.1f}{:>10.1f}{:>12.1f}'.format(
+		phase,
+		rows_fetched,
+		rows_written,
+		seconds,
+		rows_fetched / seconds if seconds > 0 else 0.0,
+		peak_rss_mb,
+		local_size / 1024 / 1024
+	))
+
+
+def compare_query_modes(app):
+	"""
+
+	fetch the bibs of both passes with each of the query modes, which 
+	get_sierra_sql promises give identical rows, and return the (pass, 
+	rows of the join mode, rows of the subquery mode, bibs whose rows 
+	differ, and the seconds of each mode)
+
+	"""
+
+	if app.pgsql_conn is None:
+		app.open_sierra_db()
+
+	query_mode = app.query_mode
+	comparisons = []
+	for deleted in (False, True):
+		params = app.get_sierra_params(0, deleted)
+		fetched = {}
+		seconds = {}
+		for mode in ('join', 'subquery'):
+			app.query_mode = mode
+			start = time.perf_counter()
+			fetched[mode] = dict((row[0], tuple(row)) for row in app.gen_sierra_bibs(params, deleted))
+			seconds[mode] = time.perf_counter() - start
+
+		differ = sum(
+			1 for bib_id in set(fetched['join']) | set(fetched['subquery'])
+			if fetched['join'].get(bib_id) != fetched['subquery'].get(bib_id)
+		)
+		comparisons.append((
+			app.get_sync_name(deleted), 
+			len(fetched['join']), 
+			len(fetched['subquery']), 
+			differ, 
+			seconds['join'], 
+			seconds['subquery']
+		))
+	app.query_mode = query_mode
+
+	return comparisons
+
+
+def run_fill(app, phase, deleted, path, results):
+	"""
+
+	run one pass of fill_local_db, and keep its numbers (from the
+	sync_runs row it recorded, with the peak rss of the run), and the
+	size of the local database right after it
+
+	"""
+
+	app.fill_local_db(deleted=deleted)
+	local_size = get_local_db_size(path)
+	cursor = app.sqlite_conn.cursor()
+	cursor.execute("""
+	SELECT
+	rows_fetched,
+	rows_written,
+	seconds,
+	peak_rss_mb
+
+	FROM
+	sync_runs
+
+	ORDER BY
+	run_id DESC
+
+	LIMIT 1
+	""")
+	rows_fetched, rows_written, seconds, peak_rss_mb = cursor.fetchone()
+	cursor.close()
+	results.append((phase, rows_fetched, rows_written, seconds, peak_rss_mb, local_size))
+
+
+def remove_local_db(path):
+	for suffix in ('', '-wal', '-shm', '-journal'):
+		if os.path.exists(path + suffix):
+			os.remove(path + suffix)
+
+
+if __name__ == '__main__':
+	config = get_bench_config()
+	bench = config['bench']
+	path = config['local_db']['connection_string']
+	results = []
+
+	print('creating synthetic sierra_view ({} bibs)...'.format(bench.get('bibs', 100000)))
+	conn = psycopg2.connect(bench['connection_string'])
+	create_sierra_view(conn, bench)
+
+	#~ the query modes, with nothing written
+	remove_local_db(path)
+	app = get_bibs.App(config)
+	app.open()
+	comparisons = compare_query_modes(app)
+
+	#~ the extraction on its own, with nothing written
+	start = time.perf_counter()
+	peak_rss = app.get_rss()
+	start_epoc, rows = app.get_sierra_rows(deleted=False)
+	count = 0
+	for row in rows:
+		count += 1
+		#~ (sampled as the runs sample it, rather than the peak of the 
+		#~ process, which includes whatever ran before)
+		if count % 1000 == 0:
+			peak_rss = max(peak_rss, app.get_rss())
+	seconds = time.perf_counter() - start
+	peak_rss = max(peak_rss, app.get_rss())
+	results.append(('extract live (full)', count, 0, seconds, peak_rss / 1024 / 1024, get_local_db_size(path)))
+	app.close_connections()
+
+	#~ a full load into an empty local database, then an incremental
+	#~ run after a day's worth of changes
+	remove_local_db(path)
+	app = get_bibs.App(config)
+	app.open()
+	run_fill(app, 'fill live (full)', False, path, results)
+	run_fill(app, 'fill deleted (full)', True, path, results)
+
+	update_sierra_view(conn, bench)
+	run_fill(app, 'fill live (incremental)', False, path, results)
+	run_fill(app, 'fill deleted (incremental)', True, path, results)
+	app.close_connections()
+	conn.close()
+
+	print('')
+	print('{:<10}{:>10}{:>10}{:>10}{:>12}{:>12}'.format(
+		'pass', 'join', 'subquery', 'differ', 'join sec', 'subq sec'
+	))
+	for comparison in comparisons:
+		print('{:<10}{:>10}{:>10}{:>10}{:>12.2f}{:>12.2f}'.format(*comparison))
+
+	print('')
+	print('{:<28}{:>10}{:>10}{:>10}{:>12}{:>10}{:>12}'.format(
+		'phase', 'fetched', 'written', 'seconds', 'rows/sec', 'peak MB', 'local MB'
+	))
+	for result in results:
+		report(*result)
+
+	if any(comparison[3] for comparison in comparisons):
+		sys.exit('the join and subquery modes fetched different rows')
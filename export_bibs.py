@@ -0,0 +1,362 @@
+#~ this script exports bib_data from the local database into a directory
+#~ of arrow ipc (feather v2) files, for analytics that only need a few of
+#~ the columns. The code columns are dictionary encoded, the dates are
+#~ date32 (days since 1970-01-01) and the epochs are timestamps in
+#~ seconds, and each file is compressed. The files can be memory mapped
+#~ (pyarrow.memory_map, or pyarrow.dataset.dataset(path, format='ipc')).
+#~ Each file has dictionaries of its own, so a table read from more than
+#~ one of them needs unify_dictionaries() before grouping on a code.
+#~
+#~ bib_data is split into partitions of bib_id, one file each, and only
+#~ the partitions holding bibs written by the syncs (the sync_runs of
+#~ get_bibs) since the last export are written again -- get_bibs
+#~ does this after every sync when the [export] path is set in
+#~ config.ini.
+#~
+#~ this needs pyarrow (pip install pyarrow), which get_bibs itself
+#~ doesn't.
+#~
+#~ usage: python export_bibs.py [--full]
+
+import configparser
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+
+def get_schema(pa):
+	code = pa.dictionary(pa.int16(), pa.string())
+
+	return pa.schema([
+		('bib_id', pa.int64()),
+		('record_num', pa.int32()),
+		('record_last_updated', pa.date32()),
+		('record_last_updated_epoch', pa.timestamp('s', tz='UTC')),
+		('creation_date', pa.date32()),
+		('deletion_date', pa.date32()),
+		('deletion_epoch', pa.timestamp('s', tz='UTC')),
+		('cataloging_date', pa.date32()),
+		('best_title', pa.string()),
+		('best_author', pa.string()),
+		('publish_year', pa.int32()),
+		('bib_level_code', code),
+		('material_code', code),
+		('language_code', code),
+		('country_code', code),
+		('control_num_001', pa.string()),
+		('control_num_035_is_oclc', pa.bool_()),
+		('control_num_035', pa.string()),
+		('oclc_number', pa.int64())
+	])
+
+
+def to_date(pa, values):
+	#~ the dates are stored as 'YYYY-MM-DD' text
+	text = pa.compute.utf8_slice_codeunits(pa.array(values, type=pa.string()), 0, 10)
+
+	return text.cast(pa.date32())
+
+
+def to_timestamp(pa, values):
+	#~ bibs that aren't deleted have a deletion_epoch of 0
+	epochs = pa.array(values, type=pa.float64())
+	epochs = pa.compute.if_else(pa.compute.equal(epochs, 0), None, epochs)
+
+	return epochs.cast(pa.int64(), safe=False).cast(pa.timestamp('s', tz='UTC'))
+
+
+def to_bool(pa, values):
+	return pa.array([None if value is None else bool(value) for value in values], type=pa.bool_())
+
+
+#~ how to convert the sqlite values of each of the columns that can't 
+#~ be made into their arrow type as they are
+converters = {
+	'record_last_updated': to_date,
+	'record_last_updated_epoch': to_timestamp,
+	'creation_date': to_date,
+	'deletion_date': to_date,
+	'deletion_epoch': to_timestamp,
+	'cataloging_date': to_date,
+	'control_num_035_is_oclc': to_bool
+}
+
+
+def create_export_state(sqlite_conn):
+	"""
+
+	the last sync run (of sync_runs) covered by the last export to each
+	path, and the partition size it used
+
+	"""
+
+	cursor = sqlite_conn.cursor()
+	cursor.execute("""
+	CREATE TABLE IF NOT EXISTS `export_state` (
+		`path`	TEXT PRIMARY KEY,
+		`partition_size`	INTEGER,
+		`run_id`	INTEGER,
+		`finished`	TEXT
+	);
+	""")
+
+	#~ the exports before run_id kept the high water marks of the 
+	#~ epochs in bib_data instead (which the next export starts over from)
+	cursor.execute("PRAGMA table_info(export_state)")
+	if 'run_id' not in [column[1] for column in cursor.fetchall()]:
+		cursor.execute("ALTER TABLE export_state ADD COLUMN `run_id` INTEGER")
+
+	sqlite_conn.commit()
+	cursor.close()
+
+
+def get_last_run_id(sqlite_conn):
+	#~ the last sync run so far, or None when there's no sync_runs
+	cursor = sqlite_conn.cursor()
+	cursor.execute("SELECT name FROM sqlite_master WHERE name = 'sync_runs'")
+	if cursor.fetchone() is None:
+		cursor.close()
+		return None
+
+	cursor.execute("SELECT IFNULL(MAX(run_id), 0) FROM sync_runs")
+	run_id = cursor.fetchone()[0]
+	cursor.close()
+
+	return run_id
+
+
+def get_sync_windows(sqlite_conn, run_id):
+	"""
+
+	return the epochs from which the runs of the live and the deleted 
+	passes since the run run_id wrote their bibs (None for a pass that 
+	hasn't run since). These come from the watermarks each run started 
+	from rather than from the epochs in bib_data, which the other pass 
+	can move past the bibs the next run of a pass fetches
+
+	"""
+
+	cursor = sqlite_conn.cursor()
+	cursor.execute("""
+	SELECT
+	sync_name,
+	MIN(start_epoch)
+
+	FROM
+	sync_runs
+
+	WHERE
+	run_id > ?
+
+	GROUP BY
+	sync_name
+	""", (run_id, ))
+	windows = dict(cursor.fetchall())
+	cursor.close()
+
+	return windows.get('live'), windows.get('deleted')
+
+
+def get_partitions(sqlite_conn, partition_size, windows):
+	"""
+
+	return the partitions to write: all of them (when windows is None), 
+	or the ones holding bibs written by the runs since the last export, 
+	given their windows (from get_sync_windows). Those are looked up with 
+	the indexes on the epochs
+
+	"""
+
+	cursor = sqlite_conn.cursor()
+	if windows is None:
+		cursor.execute("SELECT DISTINCT bib_id / ? FROM bib_data", (partition_size, ))
+		partitions = sorted(partition for partition, in cursor.fetchall())
+		cursor.close()
+
+		return partitions
+
+	live_epoch, deletion_epoch = windows
+	partitions = set()
+
+	#~ the live pass fetches the bibs updated after the epoch it starts 
+	#~ from
+	if live_epoch is not None:
+		cursor.execute("""
+		SELECT
+		DISTINCT bib_id / ?
+
+		FROM
+		bib_data
+
+		WHERE
+		record_last_updated_epoch > ?
+		""", (partition_size, live_epoch))
+		partitions.update(partition for partition, in cursor.fetchall())
+
+	#~ ... and the deleted pass the bibs deleted on or after the day of 
+	#~ it (in the time zone of the sierra session, so from the day before)
+	if deletion_epoch is not None:
+		cursor.execute("""
+		SELECT
+		DISTINCT bib_id / ?
+
+		FROM
+		bib_data
+
+		WHERE
+		deletion_epoch >= ?
+		AND deletion_epoch > 0
+		""", (partition_size, deletion_epoch - 86400))
+		partitions.update(partition for partition, in cursor.fetchall())
+
+	cursor.close()
+
+	return sorted(partitions)
+
+
+def write_partition(pa, sqlite_conn, path, schema, partition, partition_size, options):
+	"""
+
+	write the bibs of one partition to its file (under a temporary name,
+	moved into place once it's complete). Returns the number of rows
+
+	"""
+
+	cursor = sqlite_conn.cursor()
+	cursor.execute("SELECT {} FROM bib_data WHERE bib_id BETWEEN ? AND ? ORDER BY bib_id".format(
+		', '.join(schema.names)
+	), (partition * partition_size, (partition + 1) * partition_size - 1))
+	rows = cursor.fetchall()
+	cursor.close()
+
+	columns = []
+	for i, field in enumerate(schema):
+		values = [row[i] for row in rows]
+		convert = converters.get(field.name)
+		if convert is None:
+			columns.append(pa.array(values, type=field.type))
+		else:
+			columns.append(convert(pa, values))
+
+	table = pa.Table.from_arrays(columns, schema=schema)
+	file_path = os.path.join(path, 'part-{:08d}.arrow'.format(partition))
+	temp_path = file_path + '.tmp'
+	with pa.ipc.new_file(temp_path, schema, options=options) as writer:
+		writer.write_table(table)
+	os.replace(temp_path, file_path)
+
+	return len(rows)
+
+
+def export_bib_data(sqlite_conn, path, partition_size=100000, compression='zstd', full=False):
+	"""
+
+	export bib_data into the directory path, writing only the partitions
+	changed since the last export unless full is True. compression is
+	'zstd', 'lz4' or 'none' (for files that can be read without copying
+	them out of the memory map). Returns the number of partitions and
+	rows written
+
+	"""
+
+	try:
+		import pyarrow as pa
+		import pyarrow.compute
+		import pyarrow.ipc
+	except ImportError:
+		raise ImportError('the export of bib_data needs pyarrow (pip install pyarrow)')
+
+	create_export_state(sqlite_conn)
+	cursor = sqlite_conn.cursor()
+
+	state = None
+	if full == False and os.path.isdir(path):
+		cursor.execute("""
+		SELECT
+		partition_size,
+		run_id
+
+		FROM
+		export_state
+
+		WHERE
+		path = ?
+		""", (path, ))
+		state = cursor.fetchone()
+		#~ a new partition size (or no run to start from) means writing 
+		#~ all of them
+		if state is not None and (state[0] != partition_size or state[1] is None):
+			state = None
+	cursor.close()
+
+	#~ the last run is read before the export, so anything written 
+	#~ while it runs is exported (again) the next time
+	run_id = get_last_run_id(sqlite_conn)
+	if run_id is None:
+		state = None
+
+	if state is None:
+		windows = None
+	else:
+		windows = get_sync_windows(sqlite_conn, state[1])
+
+	partitions = get_partitions(sqlite_conn, partition_size, windows)
+
+	os.makedirs(path, exist_ok=True)
+	schema = get_schema(pa)
+	options = pa.ipc.IpcWriteOptions(compression=None if compression == 'none' else compression)
+
+	rows = 0
+	for partition in partitions:
+		rows += write_partition(pa, sqlite_conn, path, schema, partition, partition_size, options)
+
+	#~ a full export leaves no files from another partition size behind
+	if state is None:
+		names = set('part-{:08d}.arrow'.format(partition) for partition in partitions)
+		for name in os.listdir(path):
+			if name.startswith('part-') and name not in names:
+				os.remove(os.path.join(path, name))
+
+	cursor = sqlite_conn.cursor()
+	cursor.execute("""
+	INSERT OR REPLACE INTO
+	export_state (
+		'path',
+		'partition_size',
+		'run_id',
+		'finished'
+	)
+
+	VALUES (
+		?,
+		?,
+		?,
+		?
+	)
+	""", (path, partition_size, run_id, datetime.now().isoformat()))
+	sqlite_conn.commit()
+	cursor.close()
+
+	return len(partitions), rows
+
+
+if __name__ == '__main__':
+	config = configparser.ConfigParser()
+	config.read('config.ini')
+	if 'export' not in config or not config['export'].get('path'):
+		sys.exit('no [export] path in config.ini')
+
+	sqlite_conn = sqlite3.connect(config['local_db']['connection_string'])
+
+	start = time.perf_counter()
+	partitions, rows = export_bib_data(
+		sqlite_conn,
+		config['export']['path'],
+		int(config['export'].get('partition_size', 100000)),
+		config['export'].get('compression', 'zstd'),
+		full='--full' in sys.argv
+	)
+	print('exported {} rows in {} partitions in {:.1f}s'.format(rows, partitions, time.perf_counter() - start))
+	sqlite_conn.close()
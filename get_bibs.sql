@@ -60,7 +60,7 @@ b.country_code,
 	SELECT
 	CASE
 		WHEN v.field_content ~* '\(ocolc\)[0-9]{6,}' 
-		THEN (regexp_matches(v.field_content, '[0-9]{6,}', 'gi'))[1]
+		THEN substring(v.field_content from '[0-9]{6,}')
 		ELSE v.field_content
 	END
 
@@ -0,0 +1,18 @@
+#~ this package will fetch data from the sierra postgresql database and
+#~ fill a local database.
+#~
+#~ usage: python -m get_bibs [--live] [--deleted] [--no-export] [--config=config.ini]
+#~        python -m get_bibs --daemon [--interval=seconds] [--config=config.ini]
+#~
+#~ it can also be imported, without connecting to anything (or needing
+#~ psycopg2) until a pass is run:
+#~
+#~   with get_bibs.App('config.ini') as app:
+#~       app.sync_live()
+#~
+#~ the App is put together in app.py from the parts of the sync: the
+#~ extraction from sierra (extract.py), the local schema and its
+#~ upgrades (schema.py), the write path (write.py), the metrics and query
+#~ plans (metrics.py), and the daemon (daemon.py)
+
+from .app import App, main
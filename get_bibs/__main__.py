@@ -0,0 +1,10 @@
+#~ python -m get_bibs: see main() in app.py
+
+import sys
+
+from .app import main
+
+
+#~ run the app!
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,439 @@
+#~ the App: its config, its connections and its passes, put together
+#~ from the parts of the sync in the other modules of the package, and
+#~ the command line
+
+import configparser
+import sqlite3
+import os
+import signal
+import threading
+import time
+from datetime import datetime
+
+from .daemon import Daemon
+from .extract import SierraExtract
+from .metrics import Metrics
+from .schema import LocalSchema
+from .write import LocalWrite
+
+
+class App(LocalSchema, SierraExtract, LocalWrite, Metrics, Daemon):
+
+	def __init__(self, config=None):
+		"""
+
+		read the options from config: a parsed config, or the path of the 
+		config file (config.ini when it's not given). Nothing is 
+		connected to until the session is opened -- with the App as a 
+		context manager, or open() -- or a pass is run
+
+		"""
+
+		if config is None or isinstance(config, str):
+			path = config or 'config.ini'
+			config = configparser.ConfigParser()
+			config.read(path)
+
+		self.setup(config)
+
+
+	def __enter__(self):
+		self.open()
+
+		return self
+
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		#~ the passes commit as they go, so all that's left on the way 
+		#~ out of a failed one is its unfinished batch
+		if self.sqlite_conn:
+			if exc_type is None:
+				self.sqlite_conn.commit()
+			else:
+				self.sqlite_conn.rollback()
+		self.close_connections()
+
+
+	def open(self):
+		"""
+
+		open the local database, and create (or upgrade) its tables, if 
+		that hasn't been done yet. Sierra is connected to when a pass 
+		first needs it
+
+		"""
+
+		if self.sqlite_conn:
+			return
+
+		self.open_local_db()
+		self.create_local_functions()
+		self.create_local_table()
+
+
+	def sync_live(self):
+		#~ fill the local database with updated and new bib record data 
+		#~ from the transaction table
+		self.open()
+		self.fill_local_db(deleted=False)
+
+
+	def sync_deleted(self):
+		#~ fill the local database with deleted bib record data from 
+		#~ the transaction table
+		self.open()
+		self.fill_local_db(deleted=True)
+
+
+	def sync(self):
+		"""
+
+		run both passes of the sync, and refresh the export
+
+		"""
+
+		self.sync_live()
+		
+		#~ TODO:
+		#~ consider doing this only once a day, or maybe, take "deleted" 
+		#~ as a paramater of the constructor, so we don't necessarily do 
+		#~ it every time. Since we're going to be forced to insert the 
+		#~ same deleted records that match the date of the last deleted 
+		#~ record (because of lack of a timestamp, or date precision on 
+		#~ the "deleted_date_gmt" field
+		
+		self.sync_deleted()
+
+		#~ bring the columnar export of bib_data up to date
+		if self.export_path:
+			self.export_local_table()
+
+
+	def setup(self, config):
+		"""
+
+		parse the options from the (parsed) config into local vars
+
+		"""
+
+		#~ the local database connection
+		self.sqlite_conn = None
+		#~ the remote database connection
+		self.pgsql_conn = None
+		#~ the pool of remote database connections used by the parallel
+		#~ extraction (opened when it's first needed)
+		self.pgsql_pool = None
+
+		#~ parse the options into local vars
+		self.db_connection_string = config['db']['connection_string']
+		self.local_db_connection_string = config['local_db']['connection_string']
+		self.itersize = int(config['db']['itersize'])
+		#~ the rows fetched from sierra at a time (by fetchmany, or per 
+		#~ page), and the rows written per commit -- each of them is 
+		#~ itersize unless it's set. The fetchmany of a named cursor is a 
+		#~ FETCH FORWARD of fetch_size rows, so that's the round trip to 
+		#~ sierra as well (the itersize of psycopg2's cursors only applies 
+		#~ to iterating over them, which nothing here does)
+		self.fetch_size = int(config['db'].get('fetch_size') or self.itersize)
+		self.commit_size = int(config['local_db'].get('commit_size') or self.itersize)
+		#~ 'fixed' keeps those sizes, 'adaptive' tunes the fetch size from 
+		#~ the time each fetch takes and the commit size from the time 
+		#~ each commit takes (when write_mode is 'batch'), between 
+		#~ min_batch_size and max_batch_size and never over 
+		#~ batch_memory_mb of rows in a batch
+		self.batch_mode = config['db'].get('batch_mode', 'fixed')
+		self.target_fetch_seconds = float(config['db'].get('target_fetch_seconds', 0.5))
+		self.target_commit_share = float(config['local_db'].get('target_commit_share', 0.05))
+		self.min_batch_size = int(config['db'].get('min_batch_size', 500))
+		self.max_batch_size = int(config['db'].get('max_batch_size', 100000))
+		self.batch_memory = int(config['db'].get('batch_memory_mb', 64)) * 1024 * 1024
+		#~ the bytes a fetched row takes (once the adaptive mode, or the 
+		#~ memory budget, has seen one)
+		self.row_width = None
+		#~ the most memory (rss) the process should take, in MB (0 for no 
+		#~ budget). With a budget, the rows in flight are capped to half 
+		#~ of it and the sqlite cache to memory_cache_mb (a quarter of it 
+		#~ unless it's set), the memory is checked every 
+		#~ memory_check_rows rows, and nearing the budget commits early 
+		#~ and halves the batches. A run that can't get back under it 
+		#~ stops with a MemoryError, keeping what it committed
+		self.memory_budget = int(config['db'].get('memory_budget_mb') or 0) * 1024 * 1024
+		self.memory_cache = int(config['db'].get('memory_cache_mb') or self.memory_budget / 4 / 1024 / 1024) * 1024 * 1024
+		self.memory_check_rows = int(config['db'].get('memory_check_rows', 1000))
+		#~ set when the memory checked nears the budget, until the batch 
+		#~ being written is committed
+		self.memory_pressure = False
+		#~ the largest rss seen during the run being run, and the rss 
+		#~ left after the memory pressure was last relieved
+		self.run_peak_rss = 0
+		self.relieved_rss = 0
+		#~ 'join' fetches the control numbers with one lateral lookup of 
+		#~ the varfields per bib, 'subquery' with a correlated subquery 
+		#~ per control number
+		self.query_mode = config['db'].get('query_mode', 'join')
+		#~ 'cursor' streams everything through one named server side 
+		#~ cursor, 'paged' runs one short keyset query per fetch_size rows
+		#~ and can resume an interrupted run from the sync_state table
+		self.extract_mode = config['db'].get('extract_mode', 'cursor')
+		#~ the number of connections / id ranges fetched at the same time 
+		#~ when extract_mode is 'parallel'
+		self.workers = int(config['db'].get('workers', 4))
+		#~ fetch the next batch from sierra on a separate thread while 
+		#~ the current one is written to the local database
+		self.pipeline = config['db'].getboolean('pipeline', False)
+		#~ 'tuple' fetches plain tuples and converts them with a 
+		#~ positional function made once per pass, 'dict' fetches 
+		#~ through a DictCursor and looks up every field by name
+		self.row_mode = config['db'].get('row_mode', 'tuple')
+		#~ 'off', 'plan' (EXPLAIN the query of each run before running 
+		#~ it), or 'analyze' (EXPLAIN (ANALYZE, BUFFERS), which runs it an 
+		#~ extra time): the plans are kept in sierra_plans, and those with 
+		#~ a rows estimate off by explain_estimate_error times flagged
+		self.explain_mode = config['db'].get('explain', 'off')
+		self.explain_estimate_error = float(config['db'].get('explain_estimate_error') or 10)
+		#~ the plan of the query of the run, until the run is finished
+		self.sierra_plan = None
+		#~ 'safe', 'bulk', or 'auto' (bulk for a full rebuild into an 
+		#~ empty bib_data, safe otherwise)
+		self.load_profile = config['local_db'].get('load_profile', 'auto')
+		self.load_profiles = {
+			'safe': dict(App.load_profiles['safe']),
+			'bulk': dict(App.load_profiles['bulk'])
+		}
+		for profile in self.load_profiles:
+			section = '{}_profile'.format(profile)
+			if section in config:
+				for pragma in self.load_profiles[profile]:
+					if pragma in config[section]:
+						self.load_profiles[profile][pragma] = config[section][pragma]
+		#~ 'batch' writes self.commit_size rows per executemany / transaction,
+		#~ 'row' writes each row with its own execute
+		self.write_mode = config['local_db'].get('write_mode', 'batch')
+		#~ 'merge' upserts only the deletion columns of deleted bibs,
+		#~ 'replace' re-inserts the whole row with INSERT OR REPLACE
+		self.deleted_mode = config['local_db'].get('deleted_mode', 'merge')
+		#~ 'standard' keeps every column of bib_data as it is, 'compact' 
+		#~ keeps the rows in bib_data_compact, with the codes as ids into 
+		#~ bib_codes and the dates as day numbers, and bib_data becomes a 
+		#~ view with the same columns. The compact layout always merges 
+		#~ the deleted bibs
+		self.layout = config['local_db'].get('layout', 'standard')
+		if self.layout == 'compact':
+			self.local_table = 'bib_data_compact'
+			self.deleted_mode = 'merge'
+		else:
+			self.local_table = 'bib_data'
+		#~ the ids of the codes in bib_codes, by (column, code) (loaded 
+		#~ when they're first needed)
+		self.code_ids = None
+		#~ 'known_ids' leaves the bibs we already have as deleted on the 
+		#~ last deletion date out of the deleted pass, 'date' fetches 
+		#~ everything deleted on or after that date again
+		self.deleted_watermark = config['local_db'].get('deleted_watermark', 'known_ids')
+		#~ compare a hash of each updated / new bib with the one stored, 
+		#~ and skip writing the bibs that haven't changed
+		self.change_detection = config['local_db'].getboolean('change_detection', True)
+		#~ where to log the bibs each run made new, updated or deleted: 
+		#~ 'table' (the bib_changes table), 'ndjson' (a file per run in 
+		#~ changes_dir), both (comma separated), or 'none'
+		self.change_log = [
+			log.strip() 
+			for log in config['local_db'].get('change_log', 'none').split(',') 
+			if log.strip() not in ('', 'none')
+		]
+		self.changes_dir = config['local_db'].get('changes_dir', 'changes')
+		#~ the (bib_id, change, values) of the batch being written
+		self.batch_changes = []
+		#~ the number of bibs inserted, changed and skipped by the pass
+		self.change_counts = None
+		#~ whether the pass is a rebuild, into an empty bib_data
+		self.rebuild = False
+		#~ the sync_runs row of the pass being run, and when it started
+		self.sync_run_id = None
+		self.sync_run_start = None
+		#~ the directory of the columnar export of bib_data, refreshed 
+		#~ after every sync ('' for none), and how it's partitioned and 
+		#~ compressed (see export_bibs.py)
+		export = config['export'] if 'export' in config else {}
+		self.export_path = export.get('path', '')
+		self.export_partition_size = int(export.get('partition_size', 100000))
+		self.export_compression = export.get('compression', 'zstd')
+		#~ the seconds spent in each phase (connect, get_local_max, 
+		#~ first_row, fetch, convert, execute, commit...) since the last 
+		#~ batch was recorded, and over the whole run
+		self.timings = {}
+		self.timings_lock = threading.Lock()
+		self.run_timings = {}
+		self.run_batches = 0
+		self.batch_start = None
+		#~ the file to append a json line of the timings of every batch 
+		#~ and run to, and the prometheus textfile to write the totals of 
+		#~ the last run of each pass to ('' for neither)
+		metrics = config['metrics'] if 'metrics' in config else {}
+		self.metrics_file = metrics.get('json_file', '')
+		self.prometheus_file = metrics.get('prometheus_file', '')
+
+		#~ the number of processes reading the bibs when oclc_number is 
+		#~ backfilled (the number of cpus, unless it's set)
+		self.backfill_workers = int(config['local_db'].get('backfill_workers') or os.cpu_count() or 1)
+
+		#~ the tcp keepalives of the connections to sierra: the idle 
+		#~ seconds before the first probe, the seconds between probes, and 
+		#~ the probes lost before the connection is given up on. They keep 
+		#~ the connection of the daemon open between its cycles (and 
+		#~ notice when it's gone)
+		self.keepalives_idle = int(config['db'].get('keepalives_idle') or 60)
+		self.keepalives_interval = int(config['db'].get('keepalives_interval') or 10)
+		self.keepalives_count = int(config['db'].get('keepalives_count') or 5)
+
+		#~ the seconds from the start of one cycle of the daemon to the 
+		#~ start of the next, and how long the last cycle took
+		daemon = config['daemon'] if 'daemon' in config else {}
+		self.daemon_interval = float(daemon.get('interval_seconds') or 300)
+		self.cycle_seconds = None
+
+
+	def open_sierra_db(self):
+		#~ connect to the sierra postgresql server (psycopg2 is only 
+		#~ imported here, so the local database can be used without it)
+		import psycopg2
+
+		try:
+			connect_start = time.perf_counter()
+			self.pgsql_conn = psycopg2.connect(self.db_connection_string, **self.get_connect_args())
+			self.add_timing('connect', time.perf_counter() - connect_start)
+
+		except psycopg2.Error as e:
+			print("unable to connect to sierra database: %s" % e)
+
+
+	def get_connect_args(self):
+		#~ the connection parameters added to the connection string of 
+		#~ every connection to sierra (the pool's as well)
+		return {
+			'keepalives': 1,
+			'keepalives_idle': self.keepalives_idle,
+			'keepalives_interval': self.keepalives_interval,
+			'keepalives_count': self.keepalives_count
+		}
+
+
+	def check_sierra_db(self):
+		"""
+
+		make sure there's a working connection to sierra: the open one is 
+		checked with a trivial query, and if that fails (or there isn't 
+		one) it's opened again, along with the pool. Returns the seconds 
+		it took
+
+		"""
+
+		import psycopg2
+
+		check_start = time.perf_counter()
+		if self.pgsql_conn is not None and not self.pgsql_conn.closed:
+			try:
+				with self.pgsql_conn as conn:
+					with conn.cursor() as cursor:
+						cursor.execute("SELECT 1")
+						cursor.fetchone()
+
+				return time.perf_counter() - check_start
+
+			except psycopg2.Error as e:
+				print("lost the sierra connection: %s" % e)
+
+		#~ the connections of the pool were likely lost the same way
+		self.close_sierra_db()
+		self.open_sierra_db()
+
+		return time.perf_counter() - check_start
+
+
+	def close_sierra_pool(self):
+		if self.pgsql_pool:
+			print("closing pgsql_pool")
+			self.pgsql_pool.closeall()
+			self.pgsql_pool = None
+
+
+	def close_sierra_db(self):
+		self.close_sierra_pool()
+
+		if self.pgsql_conn:
+			if hasattr(self.pgsql_conn, 'close'):
+				print("closing pgsql_conn")
+				self.pgsql_conn.close()
+				self.pgsql_conn = None
+
+
+	def open_local_db(self):
+		#~ connect to the local sqlite database
+		try:
+			self.sqlite_conn = sqlite3.connect(self.local_db_connection_string)
+		except sqlite3.Error as e:
+			print("unable to connect to local database: %s" % e)
+
+
+	def close_connections(self):
+		print("closing database connections...")
+		self.close_sierra_db()
+
+		if self.sqlite_conn:
+			if hasattr(self.sqlite_conn, 'close'):
+				print("closing sqlite_conn")
+				self.sqlite_conn.close()
+				self.sqlite_conn = None
+
+
+def main(argv):
+	"""
+
+	run the passes asked for on the command line (both of them, and the 
+	export, when neither --live nor --deleted is given), or with 
+	--daemon, keep running cycles of them until stopped by SIGTERM or 
+	ctrl-c
+
+	"""
+
+	config = 'config.ini'
+	interval = None
+	for arg in argv:
+		if arg.startswith('--config='):
+			config = arg[len('--config='):]
+		elif arg.startswith('--interval='):
+			interval = float(arg[len('--interval='):])
+
+	if '--daemon' in argv:
+		#~ a stop asked for while a cycle runs takes effect once it's done
+		stop = threading.Event()
+		signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+		print('starting daemon at: \t\t{}'.format(datetime.now()))
+		try:
+			with App(config) as app:
+				app.run_daemon(interval, stop)
+		except KeyboardInterrupt:
+			pass
+		print('stopped daemon at: \t\t{}'.format(datetime.now()))
+		return
+
+	live = '--live' in argv
+	deleted = '--deleted' in argv
+	if not live and not deleted:
+		live = deleted = True
+
+	start_time = datetime.now()
+	print('starting import at: \t\t{}'.format(start_time))
+	with App(config) as app:
+		if live and deleted:
+			if '--no-export' in argv:
+				app.export_path = ''
+			app.sync()
+		elif live:
+			app.sync_live()
+		else:
+			app.sync_deleted()
+	print("done.")
+	end_time = datetime.now()
+	print('finished import at: \t\t{}'.format(end_time))
+	print('total import time: \t\t{}'.format(end_time - start_time))
@@ -0,0 +1,94 @@
+#~ the daemon: a cycle of the sync every interval, with the connections
+#~ kept open from one cycle to the next
+
+import threading
+import time
+from datetime import datetime
+
+
+class Daemon:
+	"""
+
+	the methods of the App running the sync as a daemon
+
+	"""
+
+	def run_daemon(self, interval=None, stop=None):
+		"""
+
+		run a cycle of the sync every interval seconds (the configured 
+		interval_seconds, unless it's given) until stop -- a 
+		threading.Event -- is set. The local database, its tables and 
+		the connection to sierra stay open from one cycle to the next, so 
+		a cycle with few changes only pays for the changes
+
+		"""
+
+		if interval is None:
+			interval = self.daemon_interval
+		if stop is None:
+			stop = threading.Event()
+
+		self.open()
+		cycle = 0
+		next_start = time.monotonic()
+		while not stop.is_set():
+			cycle += 1
+			self.run_cycle(cycle)
+
+			#~ cycles start on a fixed schedule, but one that overran 
+			#~ is followed straight away, rather than by the ones missed
+			next_start += interval
+			now = time.monotonic()
+			if next_start < now:
+				next_start = now
+			stop.wait(next_start - now)
+
+
+	def run_cycle(self, cycle):
+		"""
+
+		run one cycle of the daemon: check the connection to sierra, sync 
+		both passes and the export, and report how long it took. A cycle 
+		that fails -- on either database, or on anything else, like the 
+		memory ceiling -- is rolled back and reported rather than ending 
+		the daemon. The high water mark of a pass only moves once its run 
+		is complete, so the next cycle fetches again whatever the failed 
+		one hadn't
+
+		"""
+
+		cycle_start = time.perf_counter()
+		check_seconds = self.check_sierra_db()
+		if self.pgsql_conn is None:
+			complete = False
+			print('cycle {}: sierra is unavailable, skipping it'.format(cycle))
+		else:
+			try:
+				self.sync()
+				complete = True
+
+			except Exception as e:
+				self.sqlite_conn.rollback()
+				#~ the connections of the pool may have been lost with it, 
+				#~ so the next cycle starts with a new one
+				self.close_sierra_pool()
+				complete = False
+				print('cycle {}: failed: {}: {}'.format(cycle, type(e).__name__, e))
+
+		seconds = time.perf_counter() - cycle_start
+		if complete:
+			self.cycle_seconds = seconds
+		print('cycle {}: {:.3f}s (connection check: {:.3f}s)'.format(cycle, seconds, check_seconds))
+
+		self.write_metrics_line({
+			'event': 'cycle',
+			'time': datetime.now().isoformat(),
+			'cycle': cycle,
+			'complete': complete,
+			'seconds': seconds,
+			'check_seconds': check_seconds
+		})
+
+		if complete and self.prometheus_file:
+			self.write_prometheus_file()
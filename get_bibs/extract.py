@@ -0,0 +1,815 @@
+#~ the extraction of the bibs from sierra: the sql of the sierra query,
+#~ for each pass and query mode, and the generators of its rows for
+#~ each extract mode (one server side cursor, keyset pages, COPY, or
+#~ ranges of ids over several connections), along with the pipeline
+#~ that fetches them on a thread of its own
+
+import csv
+import os
+import queue
+import threading
+import time
+
+
+class SierraExtract:
+	"""
+
+	the methods of the App fetching the rows of a pass from sierra
+
+	"""
+
+	def get_sierra_filter(self, deleted=False):
+		"""
+
+		return the conditions that select either the updated / new bibs, 
+		or the deleted bibs. The query parameters for them are given by 
+		get_sierra_params
+
+		"""
+
+		where = ""
+		if deleted == False:
+			where += str("AND r.record_last_updated_gmt > to_timestamp(%s)\n")
+			where += str("AND r.deletion_date_gmt IS NULL")
+		elif deleted == True:
+			where += str("AND r.deletion_date_gmt IS NOT NULL\n")
+			"""
+			there isn't very much precision when it comes to deleted 
+			records, so the date is going to have to do. We have to be 
+			careful to grab dates after our max deletion date, and 
+			exactly matching because of the lack of precision
+			
+			tldr;we're going to have to grab every deleted from the 
+			date of the last deleted record because there's no 
+			timestamp on the deletion_date_gmt field :(
+			
+			"""
+			where += str("AND r.deletion_date_gmt::date >= to_timestamp(%s)::date")
+
+			if self.deleted_watermark == 'known_ids':
+				#~ ... but we can at least leave out the ones we already 
+				#~ have as deleted
+				where += str("\nAND NOT (r.id = ANY(%s::bigint[]))")
+
+		return where
+
+
+	def get_sierra_params(self, start_epoc, deleted=False):
+		"""
+
+		return the query parameters for the conditions from 
+		get_sierra_filter
+
+		"""
+
+		if deleted == True and self.deleted_watermark == 'known_ids':
+			return (start_epoc, self.get_known_deleted_ids(start_epoc))
+		else:
+			return (start_epoc, )
+
+
+	def get_known_deleted_ids(self, start_epoc):
+		"""
+
+		return the ids of the bibs we already have as deleted on (or 
+		after) the day of start_epoc -- these would otherwise be fetched 
+		and written again on every run. The day before start_epoc is 
+		included as well, so this holds whatever the time zone of the 
+		sierra session is
+
+		"""
+
+		cursor = self.sqlite_conn.cursor()
+		cursor.execute("""
+		SELECT
+		bib_id
+
+		FROM
+		{}
+
+		WHERE
+		-- (the deletion dates are whole days, so the bibs deleted the 
+		-- day before have exactly this epoch)
+		deletion_epoch >= ?
+		-- bibs that aren't deleted have a deletion_epoch of 0
+		AND deletion_epoch > 0
+		""".format(self.local_table), (start_epoc - 86400, ))
+		known_ids = [row[0] for row in cursor.fetchall()]
+		cursor.close()
+		cursor = None
+
+		print('known deleted bibs left out: \t{}'.format(len(known_ids)))
+
+		return known_ids
+
+
+	def get_sierra_sql(self, deleted=False, paged=False, id_range=False):
+		"""
+
+		return the sql used to fetch bibs from sierra, in the form given 
+		by self.query_mode:
+
+		'subquery' looks up the control numbers with three correlated 
+		subqueries against varfield for every bib
+
+		'join' picks the bibs first, and joins each of them to the first 
+		o001 and o035 of its varfields with a single lateral lookup. Both 
+		forms return identical rows (bench_sync.py checks this)
+
+		if paged is True, the sql returns a single page of rows ordered 
+		by (record_last_updated_gmt, id), and takes three more query 
+		parameters: the last key fetched (epoch and id), and the page size
+
+		if id_range is True, the sql is limited to the bibs with an id 
+		between the two (inclusive) query parameters following the ones 
+		of the filter
+
+		"""
+
+		where = self.get_sierra_filter(deleted)
+		order = ""
+		limit = ""
+		if id_range == True:
+			where += str("\nAND r.id BETWEEN %s AND %s")
+		if paged == True:
+			where += str("\nAND (r.record_last_updated_gmt, r.id) > (to_timestamp(%s), %s)")
+			order = str("\nORDER BY\nr.record_last_updated_gmt,\nr.id")
+			limit = str("\nLIMIT %s")
+
+		if self.query_mode == 'join':
+			sql = """
+			WITH bibs AS (
+				SELECT
+				r.id,
+				r.record_num,
+				r.record_last_updated_gmt,
+				r.creation_date_gmt,
+				r.deletion_date_gmt
+
+				FROM
+				sierra_view.record_metadata as r
+
+				WHERE
+				r.record_type_code || r.campus_code = 'b'
+			""" + where + order + limit + """
+			)
+
+			SELECT
+			r.id,
+			r.record_num,
+			r.record_last_updated_gmt::date as record_last_update,
+			extract(epoch from (r.record_last_updated_gmt)) as record_last_updated_epoch,
+			r.creation_date_gmt::date,
+			r.deletion_date_gmt::date,
+			extract(epoch from (r.deletion_date_gmt)) as deletion_epoch,
+			b.cataloging_date_gmt::date,
+			p.best_title,
+			p.best_author,
+			p.publish_year,
+			p.bib_level_code,
+			p.material_code,
+			b.language_code,
+			b.country_code,
+			c.control_num_001,
+			c.control_num_035 ~* '\\(ocolc\\)[0-9]{6,}' as control_num_035_is_oclc,
+			CASE
+				WHEN c.control_num_035 ~* '\\(ocolc\\)[0-9]{6,}'
+				THEN substring(c.control_num_035 from '[0-9]{6,}')
+				ELSE c.control_num_035
+			END as control_num_035
+
+			FROM
+			bibs as r
+
+			LEFT OUTER JOIN
+			sierra_view.bib_record_property as p
+			ON
+			p.bib_record_id = r.id
+
+			LEFT OUTER JOIN
+			sierra_view.bib_record as b
+			ON
+			b.record_id = r.id
+
+			-- the first o001 and o035 (by occ_num) of the bib, in one 
+			-- lookup of its varfields. (Not joined back from a CTE of 
+			-- them: the bibs are often estimated at a few rows, which 
+			-- turned those joins into nested loops over all of them)
+			LEFT OUTER JOIN LATERAL (
+				SELECT
+				(array_agg(v.field_content ORDER BY v.occ_num) FILTER (WHERE v.marc_tag = '001'))[1] as control_num_001,
+				(array_agg(v.field_content ORDER BY v.occ_num) FILTER (WHERE v.marc_tag = '035'))[1] as control_num_035
+
+				FROM
+				sierra_view.varfield as v
+
+				WHERE
+				v.record_id = r.id
+				AND v.varfield_type_code = 'o'
+				AND v.marc_tag IN ('001', '035')
+			) as c
+			ON
+			true
+			""" + order
+
+		else:
+			sql = """
+			SELECT
+			r.id,
+			r.record_num,
+			r.record_last_updated_gmt::date as record_last_update,
+			extract(epoch from (r.record_last_updated_gmt)) as record_last_updated_epoch,
+			r.creation_date_gmt::date,
+			r.deletion_date_gmt::date,
+			extract(epoch from (r.deletion_date_gmt)) as deletion_epoch,
+			b.cataloging_date_gmt::date,
+			p.best_title,
+			p.best_author,
+			p.publish_year,
+			p.bib_level_code,
+			p.material_code,
+			b.language_code,
+			b.country_code,
+			(
+				SELECT
+				v.field_content
+
+				FROM
+				sierra_view.varfield as v
+
+				WHERE
+				v.record_id = r.id
+				AND v.varfield_type_code || v.marc_tag = 'o001'
+				-- and v.marc_tag = '001'
+
+				ORDER BY
+				v.occ_num
+
+				LIMIT 1
+
+			) as control_num_001,
+
+			(
+				SELECT
+				CASE
+					WHEN v.field_content ~* '\\(ocolc\\)[0-9]{6,}'
+					THEN true
+					ELSE false
+				END
+
+				FROM
+				sierra_view.varfield as v
+
+				WHERE
+				v.record_id = r.id
+				AND v.varfield_type_code || v.marc_tag = 'o035'
+				-- and v.marc_tag = '001'
+
+				ORDER BY
+				v.occ_num
+
+				LIMIT 1
+
+			) as control_num_035_is_oclc,
+
+			(
+				SELECT
+				CASE
+					WHEN v.field_content ~* '\\(ocolc\\)[0-9]{6,}'
+					THEN substring(v.field_content from '[0-9]{6,}')
+					ELSE v.field_content
+				END
+
+				FROM
+				sierra_view.varfield as v
+
+				WHERE
+				v.record_id = r.id
+				AND v.varfield_type_code || v.marc_tag = 'o035'
+				-- and v.marc_tag = '001'
+
+				ORDER BY
+				v.occ_num
+
+				LIMIT 1
+
+			) as control_num_035
+
+			FROM
+			sierra_view.record_metadata as r
+
+			LEFT OUTER JOIN
+			sierra_view.bib_record_property as p
+			ON
+			p.bib_record_id = r.id
+
+			LEFT OUTER JOIN
+			sierra_view.bib_record as b
+			ON
+			b.record_id = r.id
+
+			WHERE
+			r.record_type_code || r.campus_code = 'b'
+		
+			"""
+			sql += where + order + limit
+
+		return sql
+
+
+	def gen_sierra_bibs(self, params, deleted=False):
+		"""
+
+		here, we'd like to search for bib's where the update time is
+		less than the last updated record from our local database
+
+		"""
+
+		sql = self.get_sierra_sql(deleted)
+
+		#~ debug
+		#~ print("params: {}\nsql :{}".format(params, sql))
+
+		#~ debug
+		#~ sql += "  LIMIT 5000"
+
+		if self.explain_mode != 'off':
+			self.explain_sierra_query(sql, params)
+
+		with self.pgsql_conn as conn:
+			with conn.cursor(name='latest_bibs_cursor', cursor_factory=self.get_cursor_factory()) as cursor:
+				#~ execute the query with the query parameters
+				fetch_start = time.perf_counter()
+				cursor.execute(sql, params)
+
+				#~ fetch and yield self.fetch_size number of rows per round 
+				#~ (the first of which waits for the query to run)
+				phase = 'first_row'
+				rows = None
+				while True:
+					fetch_size = self.fetch_size
+					rows = cursor.fetchmany(fetch_size)
+					seconds = time.perf_counter() - fetch_start
+					self.add_timing(phase, seconds)
+					if not rows:
+						break
+
+					if phase == 'fetch':
+						self.tune_fetch_size(rows, fetch_size, seconds)
+					phase = 'fetch'
+					for row in rows:
+						# do something with row
+						yield row
+					fetch_start = time.perf_counter()
+		cursor.close()
+
+
+	def gen_sierra_bibs_paged(self, params, last_key, deleted=False):
+		"""
+
+		yield the same rows as gen_sierra_bibs, but ordered by 
+		(record_last_updated_gmt, id) and fetched one page of 
+		self.fetch_size rows at a time, each page being its own short 
+		query and transaction on the sierra side. last_key is the 
+		(epoch, id) to continue after
+
+		"""
+
+		sql = self.get_sierra_sql(deleted, paged=True)
+		last_epoch, last_id = last_key
+
+		#~ (the plan of the first page)
+		if self.explain_mode != 'off':
+			self.explain_sierra_query(sql, params + (last_epoch, last_id, self.fetch_size), partial=True)
+
+		phase = 'first_row'
+		while True:
+			fetch_size = self.fetch_size
+			fetch_start = time.perf_counter()
+			with self.pgsql_conn as conn:
+				with conn.cursor(cursor_factory=self.get_cursor_factory()) as cursor:
+					cursor.execute(sql, params + (last_epoch, last_id, fetch_size))
+					rows = cursor.fetchall()
+			seconds = time.perf_counter() - fetch_start
+			self.add_timing(phase, seconds)
+			phase = 'fetch'
+
+			#~ every page is a query of its own, so they're all timed 
+			#~ the same way
+			self.tune_fetch_size(rows, fetch_size, seconds)
+
+			for row in rows:
+				yield row
+
+			if len(rows) < fetch_size:
+				break
+
+			last_epoch = rows[-1][self.column_index['record_last_updated_epoch']]
+			last_id = rows[-1][self.column_index['id']]
+
+
+	def gen_sierra_bibs_copy(self, params, deleted=False):
+		"""
+
+		yield the same rows as gen_sierra_bibs, but streamed with 
+		COPY (...) TO STDOUT as csv instead of through a DictCursor. The 
+		copy runs on a separate thread writing into a pipe, which is 
+		parsed here as it arrives, so none of the psycopg2 row objects or 
+		type adapters are involved. Each row is a tuple of the column 
+		values converted to the same python types gen_sierra_bibs gives
+
+		"""
+
+		sql = self.get_sierra_sql(deleted)
+
+		#~ COPY doesn't take query parameters, so they have to be bound 
+		#~ into the sql beforehand
+		with self.pgsql_conn.cursor() as cursor:
+			sql = cursor.mogrify(sql, params).decode('utf-8')
+
+		if self.explain_mode != 'off':
+			self.explain_sierra_query(sql, None)
+		sql = "COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true, NULL '\\N')".format(sql)
+
+		read_fd, write_fd = os.pipe()
+		errors = []
+
+		def copy_to_pipe():
+			try:
+				with open(write_fd, 'wb') as pipe:
+					with self.pgsql_conn as conn:
+						with conn.cursor() as cursor:
+							cursor.copy_expert(sql, pipe)
+			except Exception as e:
+				errors.append(e)
+
+		fetch_start = time.perf_counter()
+		thread = threading.Thread(target=copy_to_pipe, daemon=True)
+		thread.start()
+
+		finished = False
+		try:
+			with open(read_fd, 'r', encoding='utf-8', newline='') as pipe:
+				reader = csv.reader(pipe)
+				header = next(reader, None)
+
+				if header is not None:
+					converters = [self.copy_converters.get(name, str) for name in header]
+
+					#~ the rows are parsed as they're read from the pipe, so 
+					#~ only the wait for the first one is timed
+					for fields in reader:
+						if fetch_start is not None:
+							self.add_timing('first_row', time.perf_counter() - fetch_start)
+							fetch_start = None
+						yield tuple(
+							None if value == '\\N' else convert(value)
+							for convert, value in zip(converters, fields)
+						)
+			finished = True
+
+		finally:
+			#~ when the rows aren't all taken (the writing failed), the 
+			#~ copy is cancelled, and the pipe closed above ends it if it 
+			#~ was writing: either way it's joined, so it's done with 
+			#~ self.pgsql_conn before this returns
+			if not finished:
+				self.pgsql_conn.cancel()
+			thread.join()
+
+		if errors:
+			raise errors[0]
+
+
+	#~ how to convert the csv text of the COPY for each of the columns 
+	#~ that aren't text
+	copy_converters = {
+		'id': int,
+		'record_num': int,
+		'record_last_updated_epoch': float,
+		'deletion_epoch': float,
+		'publish_year': int,
+		'control_num_035_is_oclc': lambda value: value == 't'
+	}
+
+
+	def get_sierra_id_ranges(self, params, deleted=False):
+		"""
+
+		split the ids of the bibs matching the query (given the query 
+		parameters of the filter) into self.workers (inclusive) ranges of 
+		about the same width
+
+		"""
+
+		sql = """
+		SELECT
+		MIN(r.id),
+		MAX(r.id)
+
+		FROM
+		sierra_view.record_metadata as r
+
+		WHERE
+		r.record_type_code || r.campus_code = 'b'
+		""" + self.get_sierra_filter(deleted)
+
+		with self.pgsql_conn as conn:
+			with conn.cursor() as cursor:
+				cursor.execute(sql, params)
+				min_id, max_id = cursor.fetchone()
+
+		if min_id is None:
+			return []
+
+		width = (max_id - min_id) // self.workers + 1
+		ranges = []
+		for low in range(min_id, max_id + 1, width):
+			ranges.append((low, min(low + width - 1, max_id)))
+
+		return ranges
+
+
+	def put_batch(self, batches, batch, stop):
+		"""
+
+		put batch on the (bounded) batches queue from a fetching thread, 
+		unless stop is set while it waits for room -- whatever takes the 
+		batches has stopped. Returns whether it was put
+
+		"""
+
+		while not stop.is_set():
+			try:
+				batches.put(batch, timeout=0.1)
+				return True
+			except queue.Full:
+				pass
+
+		return False
+
+
+	def fetch_sierra_range(self, sql, params, batches, stop):
+		"""
+
+		run on a worker thread: fetch the rows for one id range over a 
+		connection from the pool, and put them on the batches queue 
+		self.fetch_size rows at a time. None is put on the queue when the 
+		range is done (or an exception, if it failed). Once stop is set 
+		the range is given up, and the connection goes back to the pool
+
+		"""
+
+		conn = None
+		try:
+			conn = self.pgsql_pool.getconn()
+			with conn:
+				with conn.cursor(name='range_bibs_cursor', cursor_factory=self.get_cursor_factory()) as cursor:
+					cursor.execute(sql, params)
+
+					fetched = False
+					while True:
+						fetch_size = self.fetch_size
+						fetch_start = time.perf_counter()
+						rows = cursor.fetchmany(fetch_size)
+						if not rows:
+							break
+						#~ (the first fetch waits for the query to run)
+						if fetched:
+							self.tune_fetch_size(rows, fetch_size, time.perf_counter() - fetch_start)
+						fetched = True
+						if not self.put_batch(batches, rows, stop):
+							break
+
+		except Exception as e:
+			self.put_batch(batches, e, stop)
+
+		finally:
+			if conn is not None:
+				self.pgsql_pool.putconn(conn)
+			self.put_batch(batches, None, stop)
+
+
+	def gen_sierra_bibs_parallel(self, params, deleted=False):
+		"""
+
+		yield the same rows as gen_sierra_bibs (in no particular order), 
+		fetching self.workers ranges of the bib ids at the same time. 
+		The workers feed a bounded queue, so only a few batches per 
+		worker are ever held in memory while the local database writes
+
+		"""
+
+		if self.pgsql_pool is None:
+			import psycopg2.pool
+			self.pgsql_pool = psycopg2.pool.ThreadedConnectionPool(
+				1, 
+				self.workers, 
+				self.db_connection_string, 
+				**self.get_connect_args()
+			)
+
+		sql = self.get_sierra_sql(deleted, id_range=True)
+		ranges = self.get_sierra_id_ranges(params, deleted)
+		print('fetching {} id ranges with {} workers'.format(len(ranges), self.workers))
+
+		#~ (the plan of the first range)
+		if self.explain_mode != 'off' and ranges:
+			self.explain_sierra_query(sql, params + ranges[0], partial=True)
+
+		batches = queue.Queue(maxsize=self.workers * 2)
+		stop = threading.Event()
+		threads = []
+		for low, high in ranges:
+			thread = threading.Thread(
+				target=self.fetch_sierra_range, 
+				args=(sql, params + (low, high), batches, stop), 
+				daemon=True
+			)
+			thread.start()
+			threads.append(thread)
+
+		try:
+			#~ every range puts None on the queue once it's done
+			running = len(ranges)
+			phase = 'first_row'
+			while running > 0:
+				fetch_start = time.perf_counter()
+				rows = batches.get()
+				self.add_timing(phase, time.perf_counter() - fetch_start)
+				phase = 'fetch'
+				if rows is None:
+					running -= 1
+				elif isinstance(rows, Exception):
+					raise rows
+				else:
+					for row in rows:
+						yield row
+
+		finally:
+			#~ when the rows aren't all taken (a range failed, or the 
+			#~ writing did), the workers left would wait on the full queue 
+			#~ forever: they're stopped, and have given their connections 
+			#~ back to the pool once this returns
+			stop.set()
+			for thread in threads:
+				thread.join()
+
+
+	def fetch_batches(self, rows, batches, stats, stop):
+		"""
+
+		run on the fetch thread of the pipeline: group the rows into 
+		batches of self.fetch_size, and put them on the (bounded) batches 
+		queue. None is put on the queue when the rows run out (or an 
+		exception, if fetching them failed). Once stop is set the rest 
+		of the rows are left, and closed
+
+		"""
+
+		try:
+			for batch in self.gen_batches(rows, lambda: self.fetch_size):
+				wait_start = time.perf_counter()
+				put = self.put_batch(batches, batch, stop)
+				wait = time.perf_counter() - wait_start
+				stats['fetch_wait'] += wait
+				self.add_timing('fetch_wait', wait)
+				if not put:
+					break
+
+		except Exception as e:
+			self.put_batch(batches, e, stop)
+
+		finally:
+			#~ (on this thread, where they're fetched: this stops whatever 
+			#~ fetches them in turn, like the workers of the parallel 
+			#~ extraction)
+			rows.close()
+			self.put_batch(batches, None, stop)
+
+
+	def gen_pipelined(self, rows):
+		"""
+
+		yield the rows from the generator rows, while a fetch thread 
+		keeps the next batch in flight. The queue between the two holds 
+		at most two batches, so memory stays capped at a few times 
+		self.fetch_size rows. The time each side spent waiting on the 
+		other is reported when the rows run out
+
+		"""
+
+		stats = {
+			'fetch_wait': 0.0,
+			'write_wait': 0.0
+		}
+		batches = queue.Queue(maxsize=2)
+		stop = threading.Event()
+		thread = threading.Thread(
+			target=self.fetch_batches, 
+			args=(rows, batches, stats, stop), 
+			daemon=True
+		)
+		thread.start()
+
+		try:
+			while True:
+				wait_start = time.perf_counter()
+				batch = batches.get()
+				wait = time.perf_counter() - wait_start
+				stats['write_wait'] += wait
+				self.add_timing('write_wait', wait)
+
+				if batch is None:
+					break
+				elif isinstance(batch, Exception):
+					raise batch
+
+				for row in batch:
+					yield row
+
+		finally:
+			#~ (the fetch thread is stopped as well when the writing 
+			#~ stops early)
+			stop.set()
+			thread.join()
+
+		print('fetch waited on write: \t{:.3f}s'.format(stats['fetch_wait']))
+		print('write waited on fetch: \t{:.3f}s'.format(stats['write_wait']))
+
+
+	def get_sierra_rows(self, deleted=False):
+		"""
+
+		return the epoch the pass starts from, and the generator of the 
+		rows from sierra for the pass, for the extract mode in use. It has 
+		to be a generator (an App that overrides this can't return a 
+		plain iterator), as fill_local_db closes it when the writing 
+		stops, to stop the fetching along with it
+
+		"""
+
+		if self.pgsql_conn is None:
+			self.open_sierra_db()
+
+		max_start = time.perf_counter()
+		if self.extract_mode == 'paged':
+			#~ pick up from the sync_state, rather than the local max
+			start_epoc, last_key = self.start_sync_state(deleted)
+		else:
+			#~ get the local max (sending if deleted or not)
+			start_epoc = self.get_local_max(deleted)
+		self.add_timing('get_local_max', time.perf_counter() - max_start)
+
+		print('starting with max date: \t{}'.format(start_epoc))
+
+		#~ the parameters are worked out here rather than in the 
+		#~ generators: with the pipeline on, a generator starts running 
+		#~ on the fetch thread, where the local database can't be read
+		params_start = time.perf_counter()
+		params = self.get_sierra_params(start_epoc, deleted)
+		self.add_timing('get_known_ids', time.perf_counter() - params_start)
+
+		if self.extract_mode == 'paged':
+			rows = self.gen_sierra_bibs_paged(params, last_key, deleted)
+		elif self.extract_mode == 'copy':
+			rows = self.gen_sierra_bibs_copy(params, deleted)
+		elif self.extract_mode == 'parallel':
+			rows = self.gen_sierra_bibs_parallel(params, deleted)
+		else:
+			rows = self.gen_sierra_bibs(params, deleted)
+
+		return start_epoc, rows
+
+
+	#~ the columns of the sierra query, in order (the first 18 are also 
+	#~ the order of the values inserted into bib_data)
+	sierra_columns = (
+		'id',
+		'record_num',
+		'record_last_update',
+		'record_last_updated_epoch',
+		'creation_date_gmt',
+		'deletion_date_gmt',
+		'deletion_epoch',
+		'cataloging_date_gmt',
+		'best_title',
+		'best_author',
+		'publish_year',
+		'bib_level_code',
+		'material_code',
+		'language_code',
+		'country_code',
+		'control_num_001',
+		'control_num_035_is_oclc',
+		'control_num_035'
+	)
+	column_index = dict(zip(sierra_columns, range(len(sierra_columns))))
+
+
+	def get_cursor_factory(self):
+		if self.row_mode == 'dict':
+			import psycopg2.extras
+			return psycopg2.extras.DictCursor
+		else:
+			return None
@@ -0,0 +1,410 @@
+#~ the timings of the phases of each batch and run, written to the json
+#~ metrics file and the prometheus textfile, and the plans of the sierra
+#~ query, kept in sierra_plans
+
+import json
+import os
+import time
+from datetime import datetime
+
+import query_plans
+
+
+class Metrics:
+	"""
+
+	the methods of the App timing the passes and keeping their query 
+	plans
+
+	"""
+
+	def explain_sierra_query(self, sql, params, partial=False):
+		"""
+
+		EXPLAIN the sierra query, with the parameters it's about to be 
+		run with (and ANALYZE and BUFFERS, when explain is 'analyze'), 
+		and keep the plan for the run to save once it's finished. partial 
+		is set when the query fetches only part of the rows of the run 
+		(the first page, or id range). A plan that can't be had is 
+		reported, and the sync goes on without it
+
+		"""
+
+		import psycopg2
+
+		if self.explain_mode == 'analyze':
+			options = 'ANALYZE, BUFFERS, FORMAT JSON'
+		else:
+			options = 'FORMAT JSON'
+
+		explain_start = time.perf_counter()
+		try:
+			with self.pgsql_conn as conn:
+				with conn.cursor() as cursor:
+					cursor.execute('EXPLAIN ({}) {}'.format(options, sql), params)
+					explained = cursor.fetchone()[0]
+
+		except psycopg2.Error as e:
+			print("unable to explain the sierra query: %s" % e)
+			return
+
+		seconds = time.perf_counter() - explain_start
+		self.add_timing('explain', seconds)
+
+		#~ (psycopg2 decodes the json itself, unless it came as text)
+		if isinstance(explained, str):
+			explained = json.loads(explained)
+
+		self.sierra_plan = {
+			'captured': datetime.now().isoformat(),
+			'sql': sql,
+			'params': params,
+			'explained': explained[0],
+			'seconds': seconds,
+			'partial': partial
+		}
+
+
+	def save_sierra_plan(self, rows_fetched):
+		"""
+
+		save the plan of the query of the run just finished in 
+		sierra_plans, along with what's wrong with it: sequential scans, 
+		a rows estimate off by explain_estimate_error times or more, and 
+		changes from the last plan of the pass. Without ANALYZE, the 
+		estimate is checked against the rows the run fetched (when the 
+		query fetched all of them)
+
+		"""
+
+		plan = self.sierra_plan
+		self.sierra_plan = None
+
+		summary = query_plans.summarize_plan(plan['explained'])
+		if summary['actual_rows'] is None and not plan['partial']:
+			summary['actual_rows'] = rows_fetched
+			summary['worst_estimate'] = query_plans.get_estimate_error(summary['estimated_rows'], rows_fetched)
+			summary['worst_node'] = query_plans.get_node_name(plan['explained']['Plan'])
+
+		cursor = self.sqlite_conn.cursor()
+		cursor.execute("SELECT sync_name FROM sync_runs WHERE run_id = ?", (self.sync_run_id, ))
+		sync_name = cursor.fetchone()[0]
+		cursor.execute("""
+		SELECT
+		run_id,
+		plan_shape,
+		execution_ms
+
+		FROM
+		sierra_plans
+
+		WHERE
+		sync_name = ?
+		AND extract_mode = ?
+
+		ORDER BY
+		plan_id DESC
+
+		LIMIT 1
+		""", (sync_name, self.extract_mode))
+		previous = cursor.fetchone()
+
+		flags = query_plans.get_plan_flags(summary, previous, self.explain_estimate_error)
+
+		cursor.execute("""
+		INSERT INTO
+		sierra_plans (
+			'run_id',
+			'sync_name',
+			'extract_mode',
+			'explain_mode',
+			'captured',
+			'sql',
+			'params',
+			'plan',
+			'plan_shape',
+			'explain_seconds',
+			'planning_ms',
+			'execution_ms',
+			'estimated_rows',
+			'actual_rows',
+			'shared_hit_blocks',
+			'shared_read_blocks',
+			'seq_scans',
+			'worst_estimate',
+			'flags'
+		)
+
+		VALUES (
+			?,
+			?,
+			?,
+			?,
+			?,
+			?,
+			?,
+			?,
+			?,
+			?,
+			?,
+			?,
+			?,
+			?,
+			?,
+			?,
+			?,
+			?,
+			?
+		)
+		""", (
+			self.sync_run_id,
+			sync_name,
+			self.extract_mode,
+			self.explain_mode,
+			plan['captured'],
+			plan['sql'],
+			json.dumps(plan['params'], default=str),
+			json.dumps(plan['explained']),
+			summary['plan_shape'],
+			plan['seconds'],
+			summary['planning_ms'],
+			summary['execution_ms'],
+			summary['estimated_rows'],
+			summary['actual_rows'],
+			summary['shared_hit_blocks'],
+			summary['shared_read_blocks'],
+			', '.join(summary['seq_scans']),
+			summary['worst_estimate'],
+			'; '.join(flags)
+		))
+		self.sqlite_conn.commit()
+		cursor.close()
+		cursor = None
+
+		print('query plan: \t{}'.format('; '.join(flags) or 'no problems found'))
+
+
+	def add_timing(self, phase, seconds):
+		"""
+
+		add seconds to the time spent in phase since the last batch was 
+		recorded. This may be called from the fetch threads as well
+
+		"""
+
+		with self.timings_lock:
+			self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+
+	def take_timings(self):
+		"""
+
+		return the timings since the last batch was recorded (adding them 
+		to the totals for the run), and start over
+
+		"""
+
+		with self.timings_lock:
+			timings = self.timings
+			self.timings = {}
+
+		for phase, seconds in timings.items():
+			self.run_timings[phase] = self.run_timings.get(phase, 0.0) + seconds
+
+		return timings
+
+
+	def write_metrics_line(self, metrics):
+		if not self.metrics_file:
+			return
+
+		with open(self.metrics_file, 'a') as metrics_file:
+			metrics_file.write(json.dumps(metrics, sort_keys=True) + '\n')
+
+
+	def record_batch_metrics(self, rows, written):
+		"""
+
+		record the timings of the batch of rows just committed (of which 
+		written were written) as a json line
+
+		"""
+
+		now = time.perf_counter()
+		seconds = now - self.batch_start
+		self.batch_start = now
+		self.run_batches += 1
+		rss = self.check_memory()
+
+		self.write_metrics_line({
+			'event': 'batch',
+			'time': datetime.now().isoformat(),
+			'run_id': self.sync_run_id,
+			'batch': self.run_batches,
+			'rows': rows,
+			'written': written,
+			'seconds': seconds,
+			'rows_per_sec': rows / seconds if seconds > 0 else 0.0,
+			'fetch_size': self.fetch_size,
+			'commit_size': self.commit_size,
+			'rss_mb': rss / 1024 / 1024,
+			'phases': self.take_timings()
+		})
+
+
+	def record_run_metrics(self, rows_fetched, rows_written, seconds):
+		"""
+
+		record the timings of the run just finished: the seconds spent in 
+		each phase go into sync_run_phases, a summary goes out as a json 
+		line, and the prometheus textfile is rewritten
+
+		"""
+
+		#~ anything timed after the last batch (or a run with no rows)
+		self.take_timings()
+
+		cursor = self.sqlite_conn.cursor()
+		cursor.executemany("""
+		INSERT OR REPLACE INTO
+		sync_run_phases (
+			'run_id',
+			'phase',
+			'seconds'
+		)
+
+		VALUES (
+			?,
+			?,
+			?
+		)
+		""", [(self.sync_run_id, phase, phase_seconds) for phase, phase_seconds in self.run_timings.items()])
+		cursor.execute("SELECT sync_name FROM sync_runs WHERE run_id = ?", (self.sync_run_id, ))
+		sync_name = cursor.fetchone()[0]
+		self.sqlite_conn.commit()
+		cursor.close()
+		cursor = None
+
+		self.write_metrics_line({
+			'event': 'run',
+			'time': datetime.now().isoformat(),
+			'run_id': self.sync_run_id,
+			'sync_name': sync_name,
+			'batches': self.run_batches,
+			'rows_fetched': rows_fetched,
+			'rows_written': rows_written,
+			'seconds': seconds,
+			'rows_per_sec': rows_fetched / seconds if seconds > 0 else 0.0,
+			'peak_rss_mb': self.run_peak_rss / 1024 / 1024,
+			'phases': self.run_timings
+		})
+
+		if self.prometheus_file:
+			self.write_prometheus_file()
+
+
+	def write_prometheus_file(self):
+		"""
+
+		write the numbers of the last complete run of each pass to 
+		self.prometheus_file, in the textfile format of the node exporter. 
+		The file is written under a temporary name and moved into place, 
+		so it's never read half written
+
+		"""
+
+		cursor = self.sqlite_conn.cursor()
+		cursor.execute("""
+		SELECT
+		r.run_id,
+		r.sync_name,
+		r.finished,
+		r.rows_fetched,
+		r.rows_written,
+		r.seconds,
+		r.peak_rss_mb
+
+		FROM
+		sync_runs as r
+
+		WHERE
+		r.run_id = (
+			SELECT
+			MAX(last.run_id)
+
+			FROM
+			sync_runs as last
+
+			WHERE
+			last.sync_name = r.sync_name
+			AND last.complete = 1
+		)
+
+		ORDER BY
+		r.sync_name
+		""")
+		runs = cursor.fetchall()
+
+		metrics = {
+			'rows_fetched': ('gauge', 'Rows fetched from sierra by the last run of the pass.', []),
+			'rows_written': ('gauge', 'Rows written to the local database by the last run of the pass.', []),
+			'seconds': ('gauge', 'Duration of the last run of the pass.', []),
+			'rows_per_second': ('gauge', 'Rows fetched per second by the last run of the pass.', []),
+			'phase_seconds': ('gauge', 'Seconds the last run of the pass spent in each phase.', []),
+			'peak_rss_bytes': ('gauge', 'Peak resident memory of the last run of the pass.', []),
+			'last_success_timestamp_seconds': ('gauge', 'When the last run of the pass finished.', []),
+			'cycle_seconds': ('gauge', 'Duration of the last complete cycle of the daemon.', [])
+		}
+
+		if self.cycle_seconds is not None:
+			metrics['cycle_seconds'][2].append(('', self.cycle_seconds))
+
+		for run_id, sync_name, finished, rows_fetched, rows_written, seconds, peak_rss_mb in runs:
+			labels = 'pass="{}"'.format(sync_name)
+			metrics['rows_fetched'][2].append((labels, rows_fetched))
+			metrics['rows_written'][2].append((labels, rows_written))
+			metrics['seconds'][2].append((labels, seconds))
+			metrics['rows_per_second'][2].append((labels, rows_fetched / seconds if seconds > 0 else 0.0))
+			metrics['peak_rss_bytes'][2].append((labels, int((peak_rss_mb or 0) * 1024 * 1024)))
+			metrics['last_success_timestamp_seconds'][2].append((
+				labels, 
+				datetime.strptime(finished[:19], '%Y-%m-%dT%H:%M:%S').timestamp()
+			))
+
+			cursor.execute("""
+			SELECT
+			phase,
+			seconds
+
+			FROM
+			sync_run_phases
+
+			WHERE
+			run_id = ?
+
+			ORDER BY
+			phase
+			""", (run_id, ))
+			for phase, phase_seconds in cursor.fetchall():
+				metrics['phase_seconds'][2].append((
+					'{},phase="{}"'.format(labels, phase), 
+					phase_seconds
+				))
+
+		cursor.close()
+		cursor = None
+
+		lines = []
+		for name, (metric_type, description, samples) in metrics.items():
+			lines.append('# HELP get_bibs_{} {}'.format(name, description))
+			lines.append('# TYPE get_bibs_{} {}'.format(name, metric_type))
+			for labels, value in samples:
+				if labels:
+					lines.append('get_bibs_{}{{{}}} {}'.format(name, labels, value))
+				else:
+					lines.append('get_bibs_{} {}'.format(name, value))
+
+		temp_file = self.prometheus_file + '.tmp'
+		with open(temp_file, 'w') as prometheus_file:
+			prometheus_file.write('\n'.join(lines) + '\n')
+		os.replace(temp_file, self.prometheus_file)
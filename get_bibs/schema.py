@@ -0,0 +1,655 @@
+#~ the local database: the tables, views, indexes and functions of
+#~ bib_data (in either layout), the upgrades of older local databases,
+#~ and the load profiles (the sqlite pragmas) the passes write with
+
+import sqlite3
+import time
+
+import oclc_numbers
+
+
+class LocalSchema:
+	"""
+
+	the methods of the App creating and upgrading the local database
+
+	"""
+
+	#~ the current layout of bib_data, kept in the user_version pragma 
+	#~ of the local database:
+	#~ 0 - keyed on (bib_id, record_last_updated_epoch, deletion_epoch),
+	#~ with bib_id also UNIQUE, and a unique index on bib_id
+	#~ 1 - bib_id is the INTEGER PRIMARY KEY (the rowid)
+	#~ 2 - adds content_hash
+	#~ 3 - adds the high_water_epoch to sync_state
+	#~ 4 - adds the peak_rss_mb to sync_runs
+	#~ 5 - adds oclc_number (and its index)
+	schema_version = 5
+
+	bib_data_sql = """
+		CREATE TABLE IF NOT EXISTS `{table}` (
+			`bib_id`	INTEGER PRIMARY KEY,
+			`record_num`	INTEGER,
+			`record_last_updated`	TEXT,
+			`record_last_updated_epoch`	REAL,
+			`creation_date`	TEXT,
+			`deletion_date`	TEXT,
+			`deletion_epoch`	REAL,
+			`cataloging_date`	TEXT,
+			`best_title`	TEXT,
+			`best_author`	TEXT,
+			`publish_year`	INTEGER,
+			`bib_level_code`	TEXT,
+			`material_code`	TEXT,
+			`language_code`	TEXT,
+			`country_code`	TEXT,
+			`control_num_001`	TEXT,
+			`control_num_035_is_oclc`	INTEGER,
+			`control_num_035`	TEXT,
+			`content_hash`	INTEGER,
+			`oclc_number`	INTEGER
+		);
+		"""
+
+	#~ the compact layout: the dates are days since 1970-01-01 (the 
+	#~ deletion date is the day of deletion_epoch), and the codes are ids 
+	#~ into bib_codes
+	bib_data_compact_sql = """
+		CREATE TABLE IF NOT EXISTS `bib_data_compact` (
+			`bib_id`	INTEGER PRIMARY KEY,
+			`record_num`	INTEGER,
+			`record_last_updated_day`	INTEGER,
+			`record_last_updated_epoch`	REAL,
+			`creation_day`	INTEGER,
+			`deletion_epoch`	REAL,
+			`cataloging_day`	INTEGER,
+			`best_title`	TEXT,
+			`best_author`	TEXT,
+			`publish_year`	INTEGER,
+			`bib_level_code_id`	INTEGER,
+			`material_code_id`	INTEGER,
+			`language_code_id`	INTEGER,
+			`country_code_id`	INTEGER,
+			`control_num_001`	TEXT,
+			`control_num_035_is_oclc`	INTEGER,
+			`control_num_035`	TEXT,
+			`content_hash`	INTEGER,
+			`oclc_number`	INTEGER
+		);
+		"""
+
+	bib_codes_sql = """
+		CREATE TABLE IF NOT EXISTS `bib_codes` (
+			`code_id`	INTEGER PRIMARY KEY,
+			`column_name`	TEXT,
+			`code`	TEXT,
+			UNIQUE (`column_name`, `code`)
+		);
+		"""
+
+	#~ bib_data, with the columns of the standard layout, over the 
+	#~ compact one
+	bib_data_view_sql = """
+		CREATE VIEW IF NOT EXISTS `bib_data` AS
+
+		SELECT
+		b.bib_id,
+		b.record_num,
+		date(b.record_last_updated_day * 86400, 'unixepoch') as record_last_updated,
+		b.record_last_updated_epoch,
+		date(b.creation_day * 86400, 'unixepoch') as creation_date,
+		CASE
+			WHEN b.deletion_epoch > 0 THEN date(b.deletion_epoch, 'unixepoch')
+			ELSE NULL
+		END as deletion_date,
+		b.deletion_epoch,
+		date(b.cataloging_day * 86400, 'unixepoch') as cataloging_date,
+		b.best_title,
+		b.best_author,
+		b.publish_year,
+		bib_level_code.code as bib_level_code,
+		material_code.code as material_code,
+		language_code.code as language_code,
+		country_code.code as country_code,
+		b.control_num_001,
+		b.control_num_035_is_oclc,
+		b.control_num_035,
+		b.content_hash,
+		b.oclc_number
+
+		FROM
+		bib_data_compact as b
+
+		LEFT OUTER JOIN
+		bib_codes as bib_level_code
+		ON
+		  bib_level_code.code_id = b.bib_level_code_id
+
+		LEFT OUTER JOIN
+		bib_codes as material_code
+		ON
+		  material_code.code_id = b.material_code_id
+
+		LEFT OUTER JOIN
+		bib_codes as language_code
+		ON
+		  language_code.code_id = b.language_code_id
+
+		LEFT OUTER JOIN
+		bib_codes as country_code
+		ON
+		  country_code.code_id = b.country_code_id
+		"""
+
+	#~ the columns stored as ids into bib_codes in the compact layout
+	code_columns = (
+		'bib_level_code',
+		'material_code',
+		'language_code',
+		'country_code'
+	)
+
+
+	def create_local_table(self):
+		cursor = self.sqlite_conn.cursor()
+
+		cursor.execute("PRAGMA user_version")
+		version = cursor.fetchone()[0]
+		cursor.execute("SELECT type FROM sqlite_master WHERE name = 'bib_data'")
+		exists = cursor.fetchone()
+
+		#~ (only the standard layout was ever older than version 3)
+		if exists is not None and version < self.schema_version:
+			cursor.close()
+			if exists[0] == 'table':
+				self.migrate_local_table(version, 'bib_data')
+			else:
+				self.migrate_local_table(version, 'bib_data_compact')
+			cursor = self.sqlite_conn.cursor()
+
+		#~ switch an existing bib_data to the layout of the config
+		if exists is not None and exists[0] == 'table' and self.layout == 'compact':
+			cursor.close()
+			self.change_local_layout()
+			cursor = self.sqlite_conn.cursor()
+		elif exists is not None and exists[0] == 'view' and self.layout != 'compact':
+			cursor.close()
+			self.change_local_layout()
+			cursor = self.sqlite_conn.cursor()
+
+		# create the table if it doesn't exist
+		if self.layout == 'compact':
+			cursor.execute(self.bib_codes_sql)
+			cursor.execute(self.bib_data_compact_sql)
+			cursor.execute(self.bib_data_view_sql)
+		else:
+			cursor.execute(self.bib_data_sql.format(table='bib_data'))
+		cursor.execute("PRAGMA user_version = {}".format(self.schema_version))
+
+		self.create_local_indexes(cursor)
+
+		#~ the state of each of the two passes ('live' and 'deleted'): 
+		#~ the high water mark the next run starts from, and the progress 
+		#~ of the paged extraction, so an interrupted run can be resumed 
+		#~ from the last committed key
+		sql = """
+		CREATE TABLE IF NOT EXISTS `sync_state` (
+			`sync_name`	TEXT PRIMARY KEY,
+			`start_epoch`	REAL,
+			`last_epoch`	REAL,
+			`last_bib_id`	INTEGER,
+			`complete`	INTEGER,
+			`high_water_epoch`	REAL
+		);
+		"""
+		cursor.execute(sql)
+
+		#~ the history of the runs of each pass
+		sql = """
+		CREATE TABLE IF NOT EXISTS `sync_runs` (
+			`run_id`	INTEGER PRIMARY KEY,
+			`sync_name`	TEXT,
+			`started`	TEXT,
+			`finished`	TEXT,
+			`start_epoch`	REAL,
+			`high_water_epoch`	REAL,
+			`rows_fetched`	INTEGER,
+			`rows_written`	INTEGER,
+			`seconds`	REAL,
+			`complete`	INTEGER,
+			`peak_rss_mb`	REAL
+		);
+		"""
+		cursor.execute(sql)
+
+		#~ the bibs each run made new, updated or deleted (when 
+		#~ change_log includes 'table')
+		sql = """
+		CREATE TABLE IF NOT EXISTS `bib_changes` (
+			`run_id`	INTEGER,
+			`bib_id`	INTEGER,
+			`change`	TEXT,
+			PRIMARY KEY (`run_id`, `bib_id`)
+		);
+		"""
+		cursor.execute(sql)
+
+		#~ the seconds each run spent in each phase
+		sql = """
+		CREATE TABLE IF NOT EXISTS `sync_run_phases` (
+			`run_id`	INTEGER,
+			`phase`	TEXT,
+			`seconds`	REAL,
+			PRIMARY KEY (`run_id`, `phase`)
+		);
+		"""
+		cursor.execute(sql)
+
+		#~ the plans of the sierra queries of the runs (when explain 
+		#~ isn't off), and the problems found in them
+		sql = """
+		CREATE TABLE IF NOT EXISTS `sierra_plans` (
+			`plan_id`	INTEGER PRIMARY KEY,
+			`run_id`	INTEGER,
+			`sync_name`	TEXT,
+			`extract_mode`	TEXT,
+			`explain_mode`	TEXT,
+			`captured`	TEXT,
+			`sql`	TEXT,
+			`params`	TEXT,
+			`plan`	TEXT,
+			`plan_shape`	TEXT,
+			`explain_seconds`	REAL,
+			`planning_ms`	REAL,
+			`execution_ms`	REAL,
+			`estimated_rows`	REAL,
+			`actual_rows`	INTEGER,
+			`shared_hit_blocks`	INTEGER,
+			`shared_read_blocks`	INTEGER,
+			`seq_scans`	TEXT,
+			`worst_estimate`	REAL,
+			`flags`	TEXT
+		);
+		"""
+		cursor.execute(sql)
+		
+		self.sqlite_conn.commit()		
+		cursor.close()
+		cursor = None
+
+
+	def get_local_size(self):
+		cursor = self.sqlite_conn.cursor()
+		cursor.execute("PRAGMA page_count")
+		page_count = cursor.fetchone()[0]
+		cursor.execute("PRAGMA page_size")
+		page_size = cursor.fetchone()[0]
+		cursor.close()
+		cursor = None
+
+		return page_count * page_size
+
+
+	def time_local_upserts(self, table=None):
+		"""
+
+		time rewriting (the way the live pass does) up to self.itersize of 
+		the rows already in table (the table of the layout in use, unless 
+		it's given), rolling the writes back afterwards. Returns the 
+		rows / sec
+
+		"""
+
+		if table is None:
+			table = self.local_table
+
+		cursor = self.sqlite_conn.cursor()
+		cursor.execute("SELECT * FROM {} LIMIT ?".format(table), (self.itersize, ))
+		sample = cursor.fetchall()
+		if not sample:
+			return 0.0
+
+		sql = "INSERT OR REPLACE INTO {} VALUES ({})".format(
+			table, 
+			', '.join('?' * len(sample[0]))
+		)
+		start = time.perf_counter()
+		cursor.execute('BEGIN')
+		cursor.executemany(sql, sample)
+		elapsed = time.perf_counter() - start
+		self.sqlite_conn.rollback()
+		cursor.close()
+		cursor = None
+
+		return len(sample) / elapsed if elapsed > 0 else 0.0
+
+
+	def migrate_local_table(self, version, table):
+		"""
+
+		upgrade an existing local database from the given schema version 
+		to the current layout in place (table being the one holding the 
+		rows of bib_data as it is). From version 0 the rows are copied 
+		into a new table keyed on bib_id alone, the old table (and its 
+		redundant indexes) is dropped, and the file is vacuumed; later 
+		versions only add the new columns. The file size and the upsert 
+		throughput are reported before and after
+
+		"""
+
+		print('migrating bib_data from schema version {} to {}'.format(version, self.schema_version))
+		size_before = self.get_local_size()
+		rate_before = self.time_local_upserts(table)
+
+		cursor = self.sqlite_conn.cursor()
+		try:
+			cursor.execute('BEGIN')
+			if version < 1:
+				self.copy_local_table(cursor)
+			if 1 <= version < 2:
+				cursor.execute("ALTER TABLE bib_data ADD COLUMN `content_hash` INTEGER")
+			if version < 3:
+				cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sync_state'")
+				if cursor.fetchone() is not None:
+					cursor.execute("ALTER TABLE sync_state ADD COLUMN `high_water_epoch` REAL")
+			if version < 4:
+				cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sync_runs'")
+				if cursor.fetchone() is not None:
+					cursor.execute("ALTER TABLE sync_runs ADD COLUMN `peak_rss_mb` REAL")
+			if 1 <= version < 5:
+				cursor.execute("ALTER TABLE {} ADD COLUMN `oclc_number` INTEGER".format(table))
+				#~ the view of the compact layout lists its columns
+				if table == 'bib_data_compact':
+					cursor.execute("DROP VIEW bib_data")
+					cursor.execute(self.bib_data_view_sql)
+			cursor.execute("PRAGMA user_version = {}".format(self.schema_version))
+			self.sqlite_conn.commit()
+
+		except sqlite3.Error as e:
+			self.sqlite_conn.rollback()
+			print("unable to migrate bib_data: %s" % e)
+			raise
+
+		if version < 5:
+			backfill_start = time.perf_counter()
+			count = oclc_numbers.backfill_oclc_numbers(
+				self.sqlite_conn, 
+				self.local_db_connection_string, 
+				table, 
+				self.backfill_workers
+			)
+			print('backfilled {} oclc numbers in {:.1f}s'.format(count, time.perf_counter() - backfill_start))
+
+		if version < 1:
+			cursor.execute("VACUUM")
+		cursor.close()
+		cursor = None
+
+		size_after = self.get_local_size()
+		rate_after = self.time_local_upserts(table)
+		print('file size before: \t{} bytes\tafter: {} bytes'.format(size_before, size_after))
+		print('upserts/sec before: \t{:.1f}\tafter: {:.1f}'.format(rate_before, rate_after))
+
+
+	def change_local_layout(self):
+		"""
+
+		move the rows of bib_data into the layout of the config: from the 
+		standard table into bib_data_compact (and the codes into 
+		bib_codes) with the bib_data view over it, or back out of the 
+		view into a standard table. The file is vacuumed afterwards, and 
+		its size reported before and after
+
+		"""
+
+		print('changing the layout of bib_data to {}'.format(self.layout))
+		size_before = self.get_local_size()
+
+		cursor = self.sqlite_conn.cursor()
+		try:
+			cursor.execute('BEGIN')
+			if self.layout == 'compact':
+				cursor.execute(self.bib_codes_sql)
+				cursor.execute(self.bib_data_compact_sql)
+				for column in self.code_columns:
+					cursor.execute("""
+					INSERT OR IGNORE INTO
+					bib_codes (
+						column_name,
+						code
+					)
+
+					SELECT DISTINCT
+					?,
+					{0}
+
+					FROM
+					bib_data
+
+					WHERE
+					{0} IS NOT NULL
+					""".format(column), (column, ))
+
+				cursor.execute("""
+				INSERT INTO
+				bib_data_compact
+
+				SELECT
+				b.bib_id,
+				b.record_num,
+				CAST(julianday(b.record_last_updated) - 2440587.5 AS INTEGER),
+				b.record_last_updated_epoch,
+				CAST(julianday(b.creation_date) - 2440587.5 AS INTEGER),
+				b.deletion_epoch,
+				CAST(julianday(b.cataloging_date) - 2440587.5 AS INTEGER),
+				b.best_title,
+				b.best_author,
+				b.publish_year,
+				(SELECT code_id FROM bib_codes WHERE column_name = 'bib_level_code' AND code = b.bib_level_code),
+				(SELECT code_id FROM bib_codes WHERE column_name = 'material_code' AND code = b.material_code),
+				(SELECT code_id FROM bib_codes WHERE column_name = 'language_code' AND code = b.language_code),
+				(SELECT code_id FROM bib_codes WHERE column_name = 'country_code' AND code = b.country_code),
+				b.control_num_001,
+				b.control_num_035_is_oclc,
+				b.control_num_035,
+				b.content_hash,
+				b.oclc_number
+
+				FROM
+				bib_data as b
+				""")
+				cursor.execute("DROP TABLE bib_data")
+				cursor.execute(self.bib_data_view_sql)
+
+			else:
+				#~ the view has the columns of the standard table, in order
+				cursor.execute(self.bib_data_sql.format(table='bib_data_new'))
+				cursor.execute("INSERT INTO bib_data_new SELECT * FROM bib_data")
+				cursor.execute("DROP VIEW bib_data")
+				cursor.execute("DROP TABLE bib_data_compact")
+				cursor.execute("DROP TABLE bib_codes")
+				cursor.execute("ALTER TABLE bib_data_new RENAME TO bib_data")
+
+			self.create_local_indexes(cursor)
+			self.sqlite_conn.commit()
+
+		except sqlite3.Error as e:
+			self.sqlite_conn.rollback()
+			print("unable to change the layout of bib_data: %s" % e)
+			raise
+
+		cursor.execute("VACUUM")
+		cursor.close()
+		cursor = None
+
+		print('file size before: \t{} bytes\tafter: {} bytes'.format(size_before, self.get_local_size()))
+
+
+	def copy_local_table(self, cursor):
+		"""
+
+		copy the rows of a version 0 bib_data into the current layout, 
+		and replace the old table (and its indexes) with it
+
+		"""
+
+		cursor.execute(self.bib_data_sql.format(table='bib_data_new'))
+		cursor.execute("""
+		INSERT INTO
+		bib_data_new (
+			bib_id,
+			record_num,
+			record_last_updated,
+			record_last_updated_epoch,
+			creation_date,
+			deletion_date,
+			deletion_epoch,
+			cataloging_date,
+			best_title,
+			best_author,
+			publish_year,
+			bib_level_code,
+			material_code,
+			language_code,
+			country_code,
+			control_num_001,
+			control_num_035_is_oclc,
+			control_num_035
+		)
+
+		SELECT
+		bib_id,
+		record_num,
+		record_last_updated,
+		record_last_updated_epoch,
+		creation_date,
+		deletion_date,
+		deletion_epoch,
+		cataloging_date,
+		best_title,
+		best_author,
+		publish_year,
+		bib_level_code,
+		material_code,
+		language_code,
+		country_code,
+		control_num_001,
+		control_num_035_is_oclc,
+		control_num_035
+
+		FROM
+		bib_data
+
+		WHERE
+		bib_id IS NOT NULL
+		""")
+		cursor.execute("DROP TABLE bib_data")
+		cursor.execute("ALTER TABLE bib_data_new RENAME TO bib_data")
+		self.create_local_indexes(cursor)
+
+
+	#~ the secondary indexes of bib_data (or bib_data_compact) -- the 
+	#~ lookups on bib_id use the primary key
+	local_indexes = {
+		'deletion_epoch_index': """
+		CREATE INDEX IF NOT EXISTS `deletion_epoch_index` ON `{table}` (`deletion_epoch` DESC)
+		""",
+		'record_last_updated_epoch_index': """
+		CREATE INDEX IF NOT EXISTS `record_last_updated_epoch_index` ON `{table}` (`record_last_updated_epoch` DESC)
+		""",
+		#~ (with the deletion_epoch, for matching the oclc numbers of 
+		#~ deleted bibs to live ones from the index alone)
+		'oclc_number_index': """
+		CREATE INDEX IF NOT EXISTS `oclc_number_index` ON `{table}` (`oclc_number`, `deletion_epoch`) WHERE `oclc_number` IS NOT NULL
+		"""
+	}
+
+
+	def create_local_indexes(self, cursor):
+		for name, sql in self.local_indexes.items():
+			cursor.execute(sql.format(table=self.local_table))
+
+
+	def drop_local_indexes(self, cursor):
+		for name in self.local_indexes:
+			cursor.execute("DROP INDEX IF EXISTS `{}`".format(name))
+
+
+	def create_local_functions(self):
+		#~ the sql functions the local statements use: oclc_number() 
+		#~ fills the oclc_number column from the 035 as the bibs are 
+		#~ written
+		self.sqlite_conn.create_function(
+			'oclc_number', 
+			2, 
+			oclc_numbers.get_oclc_number, 
+			deterministic=True
+		)
+
+
+	#~ the pragmas set by each of the load profiles, these can be 
+	#~ changed in the [safe_profile] and [bulk_profile] sections of the 
+	#~ config. 'safe' is sqlite's defaults, 'bulk' trades durability 
+	#~ for speed while loading an empty database
+	load_profiles = {
+		'safe': {
+			'journal_mode': 'delete',
+			'synchronous': 'full',
+			'cache_size': '-2000',
+			'mmap_size': '0',
+			'temp_store': 'default'
+		},
+		'bulk': {
+			'journal_mode': 'wal',
+			'synchronous': 'off',
+			'cache_size': '-262144',
+			'mmap_size': '268435456',
+			'temp_store': 'memory'
+		}
+	}
+
+
+	def set_load_profile(self, profile):
+		"""
+
+		set the pragmas of the given load profile on the local database 
+		connection
+
+		"""
+
+		print('using load profile: \t{}'.format(profile))
+		#~ the journal mode can't be changed inside of a transaction
+		self.sqlite_conn.commit()
+		cursor = self.sqlite_conn.cursor()
+		for pragma, value in self.load_profiles[profile].items():
+			cursor.execute("PRAGMA {} = {}".format(pragma, value))
+
+		#~ with a memory budget, the page cache is capped to 
+		#~ self.memory_cache (the pages a transaction dirties past that 
+		#~ are spilled to the journal, rather than held until the commit), 
+		#~ nothing is memory mapped, and temporary tables go to disk
+		if self.memory_budget:
+			cursor.execute("PRAGMA cache_size")
+			cache_size = cursor.fetchone()[0]
+			if cache_size < 0:
+				cache_kib = -cache_size
+			else:
+				cursor.execute("PRAGMA page_size")
+				cache_kib = cache_size * cursor.fetchone()[0] / 1024
+			cursor.execute("PRAGMA cache_size = {}".format(-int(min(cache_kib, self.memory_cache / 1024))))
+			cursor.execute("PRAGMA cache_spill = 1")
+			cursor.execute("PRAGMA mmap_size = 0")
+			cursor.execute("PRAGMA temp_store = file")
+
+		cursor.close()
+		cursor = None
+
+
+	def is_local_table_empty(self):
+		cursor = self.sqlite_conn.cursor()
+		cursor.execute("SELECT 1 FROM {} LIMIT 1".format(self.local_table))
+		empty = cursor.fetchone() is None
+		cursor.close()
+		cursor = None
+
+		return empty
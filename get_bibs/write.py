@@ -0,0 +1,1607 @@
+#~ the write path: the statements writing a pass into the local
+#~ database, the conversion of the rows from sierra into their values,
+#~ the change detection and log, the batch sizes and memory budget, the
+#~ high water marks and runs kept in sync_state and sync_runs, and the
+#~ export refreshed after a sync
+
+import gc
+import hashlib
+import json
+import sqlite3
+import operator
+import os
+import resource
+import sys
+import time
+from datetime import datetime
+
+
+class LocalWrite:
+	"""
+
+	the methods of the App writing the rows of a pass into the local 
+	database
+
+	"""
+
+	#~ return the high water mark of the pass: the largest 
+	#~ record_last_updated_epoch (or deletion_epoch) written, as kept in 
+	#~ sync_state. The first time, it's found from bib_data, and saved.
+	def get_local_max(self, deleted=False):
+		print('doing deleted?: {}'.format(deleted))
+		sync_name = self.get_sync_name(deleted)
+		cursor = self.sqlite_conn.cursor()
+		cursor.execute("""
+		SELECT
+		high_water_epoch
+
+		FROM
+		sync_state
+
+		WHERE
+		sync_name = ?
+		""", (sync_name, ))
+		state = cursor.fetchone()
+		cursor.close()
+		cursor = None
+
+		if state is not None and state[0] is not None:
+			return state[0]
+
+		if deleted == False:
+			sql = """
+			SELECT
+			IFNULL(MAX(record_last_updated_epoch), 0) as max
+
+			FROM
+			{}
+
+			LIMIT 1
+			""".format(self.local_table)
+		elif deleted == True:
+			sql = """
+			SELECT
+			IFNULL(MAX(deletion_epoch), 0) as max
+
+			FROM
+			{}
+
+			LIMIT 1
+			""".format(self.local_table)
+
+		cursor = self.sqlite_conn.cursor()
+		cursor.execute(sql)
+		max_id = cursor.fetchone()[0]
+
+		cursor.execute("""
+		INSERT INTO
+		sync_state (
+			'sync_name',
+			'complete',
+			'high_water_epoch'
+		)
+
+		VALUES (
+			?,
+			1,
+			?
+		)
+
+		ON CONFLICT(sync_name) DO UPDATE SET
+			high_water_epoch = excluded.high_water_epoch
+		""", (sync_name, max_id))
+		self.sqlite_conn.commit()
+		cursor.close()
+		cursor = None
+
+		return max_id
+
+
+	def get_sync_name(self, deleted=False):
+		if deleted == False:
+			return 'live'
+		elif deleted == True:
+			return 'deleted'
+
+
+	def start_sync_state(self, deleted=False):
+		"""
+
+		read the sync_state for the pass, and return the start epoch and 
+		last key for the paged extraction. If the last run of the pass 
+		was interrupted, it's resumed from the last committed key, 
+		otherwise a new run is started (and recorded)
+
+		"""
+
+		sync_name = self.get_sync_name(deleted)
+		cursor = self.sqlite_conn.cursor()
+		cursor.execute("""
+		SELECT
+		start_epoch,
+		last_epoch,
+		last_bib_id,
+		complete
+
+		FROM
+		sync_state
+
+		WHERE
+		sync_name = ?
+		""", (sync_name, ))
+		state = cursor.fetchone()
+
+		if state is not None and not state[3]:
+			start_epoc = state[0]
+			last_key = (state[1], state[2])
+			print('resuming {} sync from key: \t{}'.format(sync_name, last_key))
+
+		else:
+			start_epoc = self.get_local_max(deleted)
+
+			#~ the deleted pass filters on the deletion date, so its key 
+			#~ has to start from the beginning
+			if deleted == False:
+				last_key = (start_epoc, 0)
+			else:
+				last_key = (0, 0)
+
+			cursor.execute("""
+			INSERT INTO
+			sync_state (
+				'sync_name',
+				'start_epoch',
+				'last_epoch',
+				'last_bib_id',
+				'complete'
+			)
+
+			VALUES (
+				?,
+				?,
+				?,
+				?,
+				0
+			)
+
+			ON CONFLICT(sync_name) DO UPDATE SET
+				start_epoch = excluded.start_epoch,
+				last_epoch = excluded.last_epoch,
+				last_bib_id = excluded.last_bib_id,
+				complete = 0
+			""", (sync_name, start_epoc, last_key[0], last_key[1]))
+			self.sqlite_conn.commit()
+
+		cursor.close()
+		cursor = None
+
+		return start_epoc, last_key
+
+
+	def start_sync_run(self, start_epoc, deleted=False):
+		"""
+
+		record the start of a run of the pass in sync_runs
+
+		"""
+
+		self.sync_run_start = time.perf_counter()
+		self.batch_start = self.sync_run_start
+		self.run_timings = {}
+		self.run_batches = 0
+		self.run_peak_rss = self.get_rss()
+		self.relieved_rss = 0
+		self.memory_pressure = False
+		#~ (a plan left over from a run that failed isn't this one's)
+		self.sierra_plan = None
+		cursor = self.sqlite_conn.cursor()
+		cursor.execute("""
+		INSERT INTO
+		sync_runs (
+			'sync_name',
+			'started',
+			'start_epoch',
+			'high_water_epoch',
+			'rows_fetched',
+			'rows_written',
+			'seconds',
+			'complete'
+		)
+
+		VALUES (
+			?,
+			?,
+			?,
+			?,
+			0,
+			0,
+			0,
+			0
+		)
+		""", (self.get_sync_name(deleted), datetime.now().isoformat(), start_epoc, start_epoc))
+		self.sync_run_id = cursor.lastrowid
+		self.sqlite_conn.commit()
+		cursor.close()
+		cursor = None
+
+
+	def save_sync_state(self, cursor, rows, written, deleted=False):
+		"""
+
+		record the rows fetched since the last commit (of which written 
+		were written): count them in the run and raise its high water 
+		mark, and for the paged extraction save the key of the last one 
+		and raise the high water mark of the pass. This uses the cursor 
+		(and so the transaction) that wrote them
+
+		"""
+
+		if not rows:
+			return
+
+		sync_name = self.get_sync_name(deleted)
+		if deleted == False:
+			epoch_column = self.column_index['record_last_updated_epoch']
+		else:
+			epoch_column = self.column_index['deletion_epoch']
+		high_water = max(float(row[epoch_column] or 0) for row in rows)
+
+		cursor.execute("""
+		UPDATE
+		sync_runs
+
+		SET
+		high_water_epoch = MAX(IFNULL(high_water_epoch, 0), ?),
+		rows_fetched = rows_fetched + ?,
+		rows_written = rows_written + ?,
+		finished = ?,
+		seconds = ?,
+		peak_rss_mb = ?
+
+		WHERE
+		run_id = ?
+		""", (
+			high_water, 
+			len(rows), 
+			written, 
+			datetime.now().isoformat(), 
+			time.perf_counter() - self.sync_run_start, 
+			self.run_peak_rss / 1024 / 1024, 
+			self.sync_run_id
+		))
+
+		#~ only the paged extraction fetches the rows in the order of 
+		#~ their epochs (and resumes from its key, rather than from the 
+		#~ high water mark). The rest fetch them in no particular order, 
+		#~ so until their run is complete, there may be rows below its 
+		#~ high water mark it hasn't fetched yet: the mark of the pass is 
+		#~ raised by finish_sync_run instead
+		if self.extract_mode == 'paged':
+			cursor.execute("""
+			UPDATE
+			sync_state
+
+			SET
+			high_water_epoch = MAX(IFNULL(high_water_epoch, 0), ?)
+
+			WHERE
+			sync_name = ?
+			""", (high_water, sync_name))
+
+			last_epoch = rows[-1][self.column_index['record_last_updated_epoch']]
+			if last_epoch is None:
+				last_epoch = 0
+			else:
+				last_epoch = float(last_epoch)
+
+			cursor.execute("""
+			UPDATE
+			sync_state
+
+			SET
+			last_epoch = ?,
+			last_bib_id = ?
+
+			WHERE
+			sync_name = ?
+			""", (last_epoch, int(rows[-1][self.column_index['id']]), sync_name))
+
+
+	def finish_sync_run(self):
+		"""
+
+		mark the run as complete, raise the high water mark of the pass 
+		to the run's, and report its throughput
+
+		"""
+
+		seconds = time.perf_counter() - self.sync_run_start
+		self.check_memory()
+		cursor = self.sqlite_conn.cursor()
+		cursor.execute("""
+		UPDATE
+		sync_runs
+
+		SET
+		finished = ?,
+		seconds = ?,
+		complete = 1,
+		peak_rss_mb = ?
+
+		WHERE
+		run_id = ?
+		""", (datetime.now().isoformat(), seconds, self.run_peak_rss / 1024 / 1024, self.sync_run_id))
+		#~ (in the same transaction, so a pass that fails before this 
+		#~ starts over from the same mark)
+		cursor.execute("""
+		UPDATE
+		sync_state
+
+		SET
+		high_water_epoch = MAX(
+			IFNULL(high_water_epoch, 0), 
+			(SELECT high_water_epoch FROM sync_runs WHERE run_id = ?)
+		)
+
+		WHERE
+		sync_name = (SELECT sync_name FROM sync_runs WHERE run_id = ?)
+		""", (self.sync_run_id, self.sync_run_id))
+		cursor.execute("SELECT rows_fetched, rows_written FROM sync_runs WHERE run_id = ?", (self.sync_run_id, ))
+		rows_fetched, rows_written = cursor.fetchone()
+		self.sqlite_conn.commit()
+		cursor.close()
+		cursor = None
+
+		if self.sierra_plan is not None:
+			self.save_sierra_plan(rows_fetched)
+
+		self.record_run_metrics(rows_fetched, rows_written, seconds)
+
+		print('run {}: fetched {} written {} in {:.1f}s ({:.1f} rows/sec)'.format(
+			self.sync_run_id, 
+			rows_fetched, 
+			rows_written, 
+			seconds, 
+			rows_fetched / seconds if seconds > 0 else 0.0
+		))
+		#~ (the peak of the run is sampled between batches, the one of 
+		#~ the process is the kernel's)
+		print('peak rss: \t{:.1f} MB\tprocess peak: {:.1f} MB'.format(
+			self.run_peak_rss / 1024 / 1024, 
+			self.get_peak_rss() / 1024 / 1024
+		))
+
+
+	def finish_sync_state(self, deleted=False):
+		cursor = self.sqlite_conn.cursor()
+		cursor.execute("""
+		UPDATE
+		sync_state
+
+		SET
+		complete = 1
+
+		WHERE
+		sync_name = ?
+		""", (self.get_sync_name(deleted), ))
+		self.sqlite_conn.commit()
+		cursor.close()
+		cursor = None
+
+
+	def export_local_table(self):
+		"""
+
+		refresh the columnar export of bib_data in self.export_path, 
+		writing only the partitions with bibs changed since the last 
+		export. The export needs pyarrow, which the sync doesn't, so if 
+		it's missing (or the export fails) that's reported and the sync 
+		is left as it is
+
+		"""
+
+		export_start = time.perf_counter()
+		try:
+			import export_bibs
+			partitions, rows = export_bibs.export_bib_data(
+				self.sqlite_conn, 
+				self.export_path, 
+				self.export_partition_size, 
+				self.export_compression
+			)
+		#~ (anything pyarrow raises included: ArrowTypeError is a 
+		#~ TypeError, ArrowNotImplementedError a NotImplementedError...)
+		except Exception as e:
+			self.sqlite_conn.rollback()
+			print("unable to export bib_data: %s: %s" % (type(e).__name__, e))
+			return
+
+		print('exported {} rows in {} partitions in {:.1f}s'.format(
+			rows, 
+			partitions, 
+			time.perf_counter() - export_start
+		))
+
+
+	def get_local_sql(self, deleted=False):
+		"""
+
+		return the statement writing the values of a bib for the pass 
+		into the local database
+
+		"""
+
+		if self.layout == 'compact':
+			return self.get_compact_sql(deleted)
+
+		#~ insert or replace into our table, the updated or new bib 
+		#~ record data		
+		if deleted == False:
+			sql = """
+			INSERT OR REPLACE INTO
+			bib_data (
+				'bib_id', --0 INTEGER NOT NULL UNIQUE,
+				'record_num', --1 INTEGER,
+				'record_last_updated', --2 TEXT
+				'record_last_updated_epoch', --3 REAL,
+				'creation_date', --4 TEXT,
+				'deletion_date', --5 TEXT,
+				'deletion_epoch', --6 TEXT,
+				'cataloging_date', --7 TEXT,
+				'best_title', --8 TEXT,
+				'best_author', --9 TEXT,
+				'publish_year', --10 INTEGER,
+				'bib_level_code', --11 TEXT,
+				'material_code', --12 TEXT,
+				'language_code', --13 TEXT,
+				'country_code', --14 TEXT,
+				'control_num_001',  --15 TEXT,
+				'control_num_035_is_oclc', --16 INTEGER,
+				'control_num_035', --17 TEXT
+				'content_hash', --18 INTEGER
+				'oclc_number' --19 INTEGER
+			)
+
+			VALUES (
+				?, --0
+				?, --1
+				?, --2
+				?, --3
+				?, --4
+				?, --5
+				?, --6
+				?, --7
+				?, --8
+				?, --9
+				?, --10
+				?, --11
+				?, --12
+				?,  --13
+				?,  --14
+				?,  --15
+				?,  --16
+				?,  --17
+				?,  --18
+				-- from the values of 16 and 17
+				oclc_number(?17, ?18)  --19
+			)
+			"""
+
+		elif deleted == True and self.deleted_mode == 'merge':
+			#~ insert the deleted record if we've never seen it, otherwise 
+			#~ update only the deletion columns of the existing row in 
+			#~ place -- this is a single lookup on bib_id per record, and 
+			#~ preserves the rest of the metadata without having to select 
+			#~ it back out (requires sqlite >= 3.24)
+			sql = """
+			INSERT INTO
+			bib_data (
+				'bib_id', --0 INTEGER NOT NULL UNIQUE,
+				'record_num', --1 INTEGER,
+				'record_last_updated', --2 TEXT
+				'record_last_updated_epoch', --3 REAL,
+				'creation_date', --4 TEXT,
+				'deletion_date', --5 TEXT,
+				'deletion_epoch', --6 REAL,
+				'cataloging_date' --7 TEXT
+			)
+
+			VALUES (
+				?, --0
+				?, --1
+				?, --2
+				?, --3
+				?, --4
+				?, --5
+				?, --6
+				?  --7
+			)
+
+			ON CONFLICT(bib_id) DO UPDATE SET
+				record_num = excluded.record_num,
+				record_last_updated = excluded.record_last_updated,
+				record_last_updated_epoch = excluded.record_last_updated_epoch,
+				creation_date = excluded.creation_date,
+				deletion_date = excluded.deletion_date,
+				deletion_epoch = excluded.deletion_epoch,
+				-- preserve the cataloging date if it had existed before
+				cataloging_date = IFNULL(bib_data.cataloging_date, excluded.cataloging_date),
+				-- the row no longer matches what the live pass wrote
+				content_hash = NULL
+			"""
+			
+		elif deleted == True:
+			sql = """
+			INSERT OR REPLACE INTO
+			bib_data (
+				'bib_id', --0 INTEGER NOT NULL UNIQUE,
+				'record_num', --1 INTEGER,
+				'record_last_updated', --2 TEXT
+				'record_last_updated_epoch', --3 REAL,
+				'creation_date', --4 TEXT,
+				'deletion_date', --5 REAL,
+				'deletion_epoch', --6 TEXT,
+				'cataloging_date', --7 TEXT,
+				'best_title', --8 TEXT,
+				'best_author', --9 TEXT,
+				'publish_year', --10 INTEGER,
+				'bib_level_code', --11 TEXT,
+				'material_code', --12 TEXT,
+				'language_code', --13 TEXT,
+				'country_code', --14 TEXT,
+				'control_num_001',  --15 TEXT,
+				'control_num_035_is_oclc', --16 INTEGER,
+				'control_num_035', --17 TEXT
+				'oclc_number' --18 INTEGER
+			)
+
+			VALUES (
+				?, --0	420909816679
+				?, --1	3021671
+				?, --2	"2016-06-15" 
+				?, --3	1466014679.0
+				?, --4	"2015-01-19"
+				?, --5	null
+				?, --6	0.0
+				-- preserve the rest if it had existed before
+				(SELECT cataloging_date FROM bib_data WHERE bib_data.bib_id = ? LIMIT 1), --7	"2015-01-19"
+				(SELECT best_title FROM bib_data WHERE bib_data.bib_id = ? LIMIT 1), --8	"Dogwood Hill [electronic resource]"
+				(SELECT best_author FROM bib_data WHERE bib_data.bib_id = ? LIMIT 1), --9	"Woods, Sherryl, author."
+				(SELECT publish_year FROM bib_data WHERE bib_data.bib_id = ? LIMIT 1), --10	2015
+				(SELECT bib_level_code FROM bib_data WHERE bib_data.bib_id = ? LIMIT 1), --11	"m"
+				(SELECT material_code FROM bib_data WHERE bib_data.bib_id = ? LIMIT 1), --12	"2"
+				(SELECT language_code FROM bib_data WHERE bib_data.bib_id = ? LIMIT 1),  --13 "eng"
+				(SELECT country_code FROM bib_data WHERE bib_data.bib_id = ? LIMIT 1),  --14 "onc"
+				(SELECT control_num_001 FROM bib_data WHERE bib_data.bib_id = ? LIMIT 1),  --15 "|aovd84EB6AB7-71B7-47C2-8AC5-847A6B209530"
+				(SELECT control_num_035_is_oclc FROM bib_data WHERE bib_data.bib_id = ? LIMIT 1),  --16 null
+				(SELECT control_num_035 FROM bib_data WHERE bib_data.bib_id = ? LIMIT 1),  --17 null
+				(SELECT oclc_number FROM bib_data WHERE bib_data.bib_id = ?1 LIMIT 1)  --18 null
+			)
+			
+			"""
+
+		return sql
+
+
+	def get_compact_sql(self, deleted=False):
+		"""
+
+		return the statements of get_local_sql for the compact layout, 
+		taking the values made by get_compactor
+
+		"""
+
+		if deleted == False:
+			sql = """
+			INSERT OR REPLACE INTO
+			bib_data_compact (
+				'bib_id', --0
+				'record_num', --1
+				'record_last_updated_day', --2
+				'record_last_updated_epoch', --3
+				'creation_day', --4
+				'deletion_epoch', --5
+				'cataloging_day', --6
+				'best_title', --7
+				'best_author', --8
+				'publish_year', --9
+				'bib_level_code_id', --10
+				'material_code_id', --11
+				'language_code_id', --12
+				'country_code_id', --13
+				'control_num_001', --14
+				'control_num_035_is_oclc', --15
+				'control_num_035', --16
+				'content_hash', --17
+				'oclc_number' --18
+			)
+
+			VALUES (
+				?, --0
+				?, --1
+				?, --2
+				?, --3
+				?, --4
+				?, --5
+				?, --6
+				?, --7
+				?, --8
+				?, --9
+				?, --10
+				?, --11
+				?, --12
+				?, --13
+				?, --14
+				?, --15
+				?, --16
+				?, --17
+				-- from the values of 15 and 16
+				oclc_number(?16, ?17)  --18
+			)
+			"""
+
+		elif deleted == True:
+			#~ (the deletion date is the day of deletion_epoch)
+			sql = """
+			INSERT INTO
+			bib_data_compact (
+				'bib_id', --0
+				'record_num', --1
+				'record_last_updated_day', --2
+				'record_last_updated_epoch', --3
+				'creation_day', --4
+				'deletion_epoch', --5
+				'cataloging_day' --6
+			)
+
+			VALUES (
+				?, --0
+				?, --1
+				?, --2
+				?, --3
+				?, --4
+				?, --5
+				?  --6
+			)
+
+			ON CONFLICT(bib_id) DO UPDATE SET
+				record_num = excluded.record_num,
+				record_last_updated_day = excluded.record_last_updated_day,
+				record_last_updated_epoch = excluded.record_last_updated_epoch,
+				creation_day = excluded.creation_day,
+				deletion_epoch = excluded.deletion_epoch,
+				-- preserve the cataloging date if it had existed before
+				cataloging_day = IFNULL(bib_data_compact.cataloging_day, excluded.cataloging_day),
+				-- the row no longer matches what the live pass wrote
+				content_hash = NULL
+			"""
+
+		return sql
+
+
+	def fill_local_db(self, deleted=False):
+		"""
+		
+		Fill the local database by updated / new bibs or update select 
+		fields for deleted bib, therefore preserving some metadata for 
+		those records
+
+		one possible way to accomplish this: 
+		https://stackoverflow.com/questions/2717590/sqlite-insert-on-duplicate-key-update
+
+		"""
+
+		sql = self.get_local_sql(deleted)
+
+		#~ (before the fetching starts, as the pipeline starts it right 
+		#~ away)
+		if self.memory_budget:
+			self.fit_memory_budget()
+
+		start_epoc, rows = self.get_sierra_rows(deleted)
+		self.start_sync_run(start_epoc, deleted)
+
+		if self.pipeline == True:
+			rows = self.gen_pipelined(rows)
+
+		if self.memory_budget:
+			rows = self.gen_memory_checked(rows)
+
+		self.change_counts = {
+			'inserted': 0,
+			'changed': 0,
+			'skipped': 0
+		}
+
+		#~ a full rebuild loads into an empty table with the secondary 
+		#~ indexes dropped, and builds them once at the end
+		rebuild = deleted == False and self.is_local_table_empty()
+		self.rebuild = rebuild
+		if self.load_profile == 'auto':
+			profile = 'bulk' if rebuild else 'safe'
+		else:
+			profile = self.load_profile
+		self.set_load_profile(profile)
+
+		if rebuild and profile == 'bulk':
+			cursor = self.sqlite_conn.cursor()
+			print('dropping secondary indexes for the rebuild')
+			self.drop_local_indexes(cursor)
+			self.sqlite_conn.commit()
+			cursor.close()
+			cursor = None
+
+		#~ write the rows out either in batches of self.commit_size with
+		#~ executemany (the default), or one at a time with execute
+		try:
+			if self.write_mode == 'batch':
+				counter = self.write_batches(sql, rows, deleted)
+			else:
+				counter = self.write_rows(sql, rows, deleted)
+
+		except Exception:
+			#~ (whatever the batch that failed had written so far isn't 
+			#~ committed with the indexes below)
+			self.sqlite_conn.rollback()
+			raise
+
+		finally:
+			#~ (if the writing failed, this stops the threads fetching 
+			#~ the rest of the rows, right away rather than whenever the 
+			#~ rows are collected. They're always a generator: see 
+			#~ get_sierra_rows)
+			rows.close()
+
+			#~ the indexes and the safe profile are put back even when 
+			#~ the writing fails, as the connection outlives the pass (in 
+			#~ the daemon, or an importer's App)
+			if rebuild and profile == 'bulk':
+				cursor = self.sqlite_conn.cursor()
+				print('building secondary indexes')
+				self.create_local_indexes(cursor)
+				self.sqlite_conn.commit()
+				cursor.close()
+				cursor = None
+
+			if profile != 'safe':
+				self.set_load_profile('safe')
+
+		if self.extract_mode == 'paged':
+			self.finish_sync_state(deleted)
+		self.finish_sync_run()
+
+		print('final count inserted ("deleted"?:{}): \t\t{}'.format(deleted, counter))
+		if deleted == False and self.change_detection == True:
+			print('inserted: {inserted}\tchanged: {changed}\tskipped: {skipped}'.format(**self.change_counts))
+
+
+	def row_values(self, row, deleted=False):
+		"""
+
+		convert a row from sierra into the tuple of values for the 
+		insert statement used by fill_local_db
+
+		"""
+
+		#~ TODO
+		#~ make sure we handle cases where the null value is returned for the column value
+
+		#~ record_last_updated_epoch and deletion_epoch can not be 
+		#~ null, so make sure of that here
+		if row['record_last_updated_epoch'] is None:
+			record_last_updated_epoch = 0.0
+		else:
+			record_last_updated_epoch = float(row['record_last_updated_epoch'])
+
+		if row['deletion_epoch'] is None:
+			deletion_epoch = 0.0
+		else:
+			deletion_epoch = float(row['deletion_epoch'])
+
+		
+		#~ set the values depending on if we're inserting deleted 
+		#~ values or not
+		
+		if deleted == False:
+			values = (
+				int(row['id']),
+				int(row['record_num']),
+				row['record_last_update'],
+				record_last_updated_epoch,
+				row['creation_date_gmt'],
+				row['deletion_date_gmt'],
+				deletion_epoch,
+				row['cataloging_date_gmt'],
+				row['best_title'],
+				row['best_author'],
+				row['publish_year'],
+				row['bib_level_code'],
+				row['material_code'],
+				row['language_code'],
+				row['country_code'],
+				row['control_num_001'],
+				row['control_num_035_is_oclc'],
+				row['control_num_035']
+			)
+			
+		elif deleted == True and self.deleted_mode == 'merge':
+			#~ only the deletion columns are written, the rest of the row 
+			#~ is left as it is
+			values = (
+				int(row['id']),
+				int(row['record_num']),
+				row['record_last_update'],
+				record_last_updated_epoch,
+				row['creation_date_gmt'],
+				row['deletion_date_gmt'],
+				deletion_epoch,
+				row['cataloging_date_gmt']
+			)
+
+		elif deleted == True:
+			values = (
+				int(row['id']),
+				int(row['record_num']),
+				row['record_last_update'],
+				record_last_updated_epoch,
+				row['creation_date_gmt'],
+				row['deletion_date_gmt'],
+				deletion_epoch,
+				row['cataloging_date_gmt'],
+				int(row['id']),
+				int(row['id']),
+				int(row['id']),
+				int(row['id']),
+				int(row['id']),
+				int(row['id']),
+				int(row['id']),
+				int(row['id']),
+				int(row['id']),
+				int(row['id'])
+			)
+
+		return values
+
+
+	#~ the columns of bib_data, in the order of the values of the live 
+	#~ insert
+	local_columns = (
+		'bib_id',
+		'record_num',
+		'record_last_updated',
+		'record_last_updated_epoch',
+		'creation_date',
+		'deletion_date',
+		'deletion_epoch',
+		'cataloging_date',
+		'best_title',
+		'best_author',
+		'publish_year',
+		'bib_level_code',
+		'material_code',
+		'language_code',
+		'country_code',
+		'control_num_001',
+		'control_num_035_is_oclc',
+		'control_num_035'
+	)
+
+
+	def get_row_converter(self, deleted=False):
+		"""
+
+		return the function converting a row from sierra into the tuple 
+		of values for the insert statement of the pass. In 'tuple' row 
+		mode (and for the COPY extraction, which always gives tuples) 
+		this is made once here, working on the column positions; in 
+		'dict' mode it's row_values
+
+		"""
+
+		if self.row_mode == 'dict' and self.extract_mode != 'copy':
+			return lambda row: self.row_values(row, deleted)
+
+		#~ the columns that go into the insert as they are
+		rest = operator.itemgetter(*range(7, len(self.sierra_columns)))
+		cataloging_date = operator.itemgetter(7)
+
+		#~ record_last_updated_epoch and deletion_epoch can not be 
+		#~ null, so make sure of that here
+		def convert_live(row):
+			return (
+				int(row[0]),
+				int(row[1]),
+				row[2],
+				float(row[3] or 0),
+				row[4],
+				row[5],
+				float(row[6] or 0)
+			) + rest(row)
+
+		def convert_deleted_merge(row):
+			return (
+				int(row[0]),
+				int(row[1]),
+				row[2],
+				float(row[3] or 0),
+				row[4],
+				row[5],
+				float(row[6] or 0),
+				cataloging_date(row)
+			)
+
+		def convert_deleted_replace(row):
+			return convert_deleted_merge(row) + (int(row[0]), ) * 10
+
+		if deleted == False:
+			return convert_live
+		elif deleted == True and self.deleted_mode == 'merge':
+			return convert_deleted_merge
+		elif deleted == True:
+			return convert_deleted_replace
+
+
+	def get_code_id(self, cursor, column, code):
+		"""
+
+		return the id of the code of the column in bib_codes, adding it if 
+		it's new
+
+		"""
+
+		if code is None:
+			return None
+
+		if self.code_ids is None:
+			cursor.execute("SELECT column_name, code, code_id FROM bib_codes")
+			self.code_ids = dict(((column_name, value), code_id) for column_name, value, code_id in cursor.fetchall())
+
+		code_id = self.code_ids.get((column, code))
+		if code_id is None:
+			cursor.execute("INSERT INTO bib_codes (column_name, code) VALUES (?, ?)", (column, code))
+			code_id = cursor.lastrowid
+			self.code_ids[(column, code)] = code_id
+
+		return code_id
+
+
+	def get_compactor(self, cursor, deleted=False):
+		"""
+
+		return the function turning the values for the insert of the pass 
+		(as made by the row converter, with the content hash for the live 
+		pass) into the values for the compact layout -- or None for the 
+		standard layout. New codes are added to bib_codes with cursor
+
+		"""
+
+		if self.layout != 'compact':
+			return None
+
+		#~ the dates come as datetime.date, or 'YYYY-MM-DD' text from the 
+		#~ COPY, and there are few enough distinct ones to keep
+		days = {}
+		def get_day(value):
+			if value is None:
+				return None
+
+			day = days.get(value)
+			if day is None:
+				if isinstance(value, str):
+					value_date = datetime.strptime(value[:10], '%Y-%m-%d')
+				else:
+					value_date = value
+				#~ 719163 is the ordinal of 1970-01-01
+				day = value_date.toordinal() - 719163
+				days[value] = day
+
+			return day
+
+		def compact_live(values):
+			return (
+				values[0],
+				values[1],
+				get_day(values[2]),
+				values[3],
+				get_day(values[4]),
+				values[6],
+				get_day(values[7]),
+				values[8],
+				values[9],
+				values[10],
+				self.get_code_id(cursor, 'bib_level_code', values[11]),
+				self.get_code_id(cursor, 'material_code', values[12]),
+				self.get_code_id(cursor, 'language_code', values[13]),
+				self.get_code_id(cursor, 'country_code', values[14]),
+				values[15],
+				values[16],
+				values[17],
+				values[18]
+			)
+
+		def compact_deleted(values):
+			return (
+				values[0],
+				values[1],
+				get_day(values[2]),
+				values[3],
+				get_day(values[4]),
+				values[6],
+				get_day(values[7])
+			)
+
+		if deleted == False:
+			return compact_live
+		else:
+			return compact_deleted
+
+
+	def write_rows(self, sql, rows, deleted=False):
+		"""
+
+		write the rows to the local database one at a time, committing 
+		every self.commit_size rows. Returns the number of rows written
+
+		"""
+
+		convert = self.get_row_converter(deleted)
+		cursor = self.sqlite_conn.cursor()
+		compact = self.get_compactor(cursor, deleted)
+
+		counter = 0
+		#~ the rows since the last commit, and how many were written
+		pending = []
+		written = 0
+		
+		for row in rows:
+
+			#~ debug
+			#~ print(row)
+
+			phase_start = time.perf_counter()
+			values = convert(row)
+			phase_end = time.perf_counter()
+			self.add_timing('convert', phase_end - phase_start)
+			if deleted == False:
+				changed = self.filter_changed(cursor, [values])
+				phase_start = phase_end
+				phase_end = time.perf_counter()
+				self.add_timing('change_detection', phase_end - phase_start)
+			else:
+				changed = [values]
+				if self.change_log:
+					self.find_deleted_changes(cursor, changed)
+
+			#~ debug
+			#~ print(values)
+			
+			if changed:
+				if compact is not None:
+					changed = [compact(changed[0])]
+				cursor.execute(sql, changed[0])
+				written += 1
+				self.add_timing('execute', time.perf_counter() - phase_end)
+			pending.append(row)
+			
+			#~ probably should commit every self.commit_size rows
+			counter += 1
+			if len(pending) >= self.commit_size or self.memory_pressure:
+				self.log_changes(cursor)
+				self.save_sync_state(cursor, pending, written, deleted)
+				commit_start = time.perf_counter()
+				self.sqlite_conn.commit()
+				self.add_timing('commit', time.perf_counter() - commit_start)
+				self.write_change_file(deleted)
+				self.record_batch_metrics(len(pending), written)
+				pending = []
+				written = 0
+				if self.memory_pressure:
+					self.relieve_memory()
+				print('counter: {}'.format(counter))
+				print('id: {}'.format(row[self.column_index['id']]))
+				print(values)
+		
+		self.log_changes(cursor)
+		self.save_sync_state(cursor, pending, written, deleted)
+		commit_start = time.perf_counter()
+		self.sqlite_conn.commit()
+		self.add_timing('commit', time.perf_counter() - commit_start)
+		self.write_change_file(deleted)
+		if pending:
+			self.record_batch_metrics(len(pending), written)
+		#~ fixes the error "UnboundLocalError: local variable 'row' 
+		#~ referenced before assignment" where there are no rows returned 
+		#~ from query		
+		if 'row' in locals():
+			print('finishing with id: \t{}'.format(row[self.column_index['id']]))
+		cursor.close()
+		cursor = None
+
+		return counter
+
+
+	def get_content_hash(self, values):
+		"""
+
+		return a 64 bit hash of the values of a bib, that's the same 
+		whichever extraction mode (and so python types) they came from. 
+		record_last_updated and its epoch (values 2 and 3) are left out: 
+		every bib the live pass fetches has a newer one, even when sierra 
+		only touched fields we don't keep, so a bib that's skipped keeps 
+		the ones of its last real change
+
+		"""
+
+		#~ (joining a list is quicker than a generator, with a hash per bib)
+		content = '\x1f'.join([
+			'\x00' if value is None else str(value) 
+			for value in values[:2] + values[4:]
+		])
+		digest = hashlib.blake2b(content.encode('utf-8'), digest_size=8).digest()
+
+		return int.from_bytes(digest, 'big', signed=True)
+
+
+	def get_stored_values(self, cursor, bib_ids, column):
+		"""
+
+		return a dict of the bib_ids we have in bib_data, to the value of 
+		the column for each (looked up in chunks, to stay under sqlite's 
+		limit on the number of query parameters)
+
+		"""
+
+		stored = {}
+		for i in range(0, len(bib_ids), 500):
+			chunk = bib_ids[i:i + 500]
+			cursor.execute(
+				"SELECT bib_id, {} FROM {} WHERE bib_id IN ({})".format(
+					column, 
+					self.local_table, 
+					', '.join('?' * len(chunk))
+				), 
+				chunk
+			)
+			stored.update(cursor.fetchall())
+
+		return stored
+
+
+	def filter_changed(self, cursor, values):
+		"""
+
+		take the values of updated / new bibs for the live insert, and 
+		return the values (with their content hash added) for only the 
+		bibs that are new, or that differ from the row we have. The 
+		counts in self.change_counts are updated, and when there's a 
+		change_log, each bib returned is noted in self.batch_changes as 
+		'new' or 'updated'
+
+		"""
+
+		if self.change_detection == False and not self.change_log:
+			return [bib + (None, ) for bib in values]
+
+		if self.change_detection == True:
+			hashed = [bib + (self.get_content_hash(bib), ) for bib in values]
+		else:
+			hashed = [bib + (None, ) for bib in values]
+
+		#~ look up the stored hashes for the batch (there are none to 
+		#~ look up in a rebuild, into an empty table)
+		if self.rebuild == True:
+			stored = {}
+		else:
+			stored = self.get_stored_values(cursor, [bib[0] for bib in hashed], 'content_hash')
+
+		changed = []
+		for bib in hashed:
+			if bib[0] not in stored:
+				self.change_counts['inserted'] += 1
+				change = 'new'
+			elif self.change_detection == False or stored[bib[0]] != bib[-1]:
+				self.change_counts['changed'] += 1
+				change = 'updated'
+			else:
+				self.change_counts['skipped'] += 1
+				continue
+
+			changed.append(bib)
+			if self.change_log:
+				self.batch_changes.append((bib[0], change, bib[:-1]))
+
+		return changed
+
+
+	def find_deleted_changes(self, cursor, values):
+		"""
+
+		take the values of the deleted bibs for the deleted insert, and 
+		note the ones we didn't already have as deleted in 
+		self.batch_changes
+
+		"""
+
+		stored = self.get_stored_values(cursor, [bib[0] for bib in values], 'deletion_epoch')
+		for bib in values:
+			#~ bibs that aren't deleted have a deletion_epoch of 0
+			if not stored.get(bib[0]):
+				self.batch_changes.append((bib[0], 'deleted', bib[:7]))
+
+
+	def log_changes(self, cursor):
+		"""
+
+		write the changes of the batch into bib_changes, with the cursor 
+		(and so in the transaction) that wrote the batch
+
+		"""
+
+		if 'table' not in self.change_log or not self.batch_changes:
+			return
+
+		cursor.executemany("""
+		INSERT OR REPLACE INTO
+		bib_changes (
+			'run_id',
+			'bib_id',
+			'change'
+		)
+
+		VALUES (
+			?,
+			?,
+			?
+		)
+		""", [(self.sync_run_id, bib_id, change) for bib_id, change, values in self.batch_changes])
+
+
+	def write_change_file(self, deleted=False):
+		"""
+
+		once the batch is committed, append its changes to the ndjson 
+		file of the run (one json object of the bib_data columns of a bib 
+		per line, with its change), and start over for the next batch
+
+		"""
+
+		if 'ndjson' in self.change_log and self.batch_changes:
+			os.makedirs(self.changes_dir, exist_ok=True)
+			path = os.path.join(
+				self.changes_dir, 
+				'run_{:06d}_{}.ndjson'.format(self.sync_run_id, self.get_sync_name(deleted))
+			)
+			with open(path, 'a') as change_file:
+				for bib_id, change, values in self.batch_changes:
+					line = {
+						'run_id': self.sync_run_id,
+						'change': change
+					}
+					line.update(zip(self.local_columns, values))
+					change_file.write(json.dumps(line, default=str) + '\n')
+
+		self.batch_changes = []
+
+
+	def get_row_width(self, row):
+		"""
+
+		return the (rough) number of bytes a fetched row takes in memory
+
+		"""
+
+		return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+
+
+	def get_batch_size(self, current, size):
+		"""
+
+		return the batch size to use in place of current, given the size 
+		wanted: no more than double or half of current at a time, between 
+		self.min_batch_size and self.max_batch_size, and no more rows than 
+		fit in self.batch_memory
+
+		"""
+
+		size = min(max(size, current / 2), current * 2)
+		size = min(max(size, self.min_batch_size), self.max_batch_size)
+		if self.row_width:
+			size = min(size, self.batch_memory / self.row_width)
+
+		return max(int(size), 1)
+
+
+	def tune_fetch_size(self, rows, fetch_size, seconds):
+		"""
+
+		in the adaptive batch_mode, size the next fetch from the last one 
+		(rows, asked for fetch_size and taking seconds): aim for each 
+		fetch to take self.target_fetch_seconds, so the round trip is only 
+		a small part of it, and fit the width of the rows into 
+		self.batch_memory. A short (so, the last) fetch says nothing 
+		about either
+
+		"""
+
+		if self.batch_mode != 'adaptive' or len(rows) < fetch_size:
+			return
+
+		self.row_width = self.get_row_width(rows[0])
+		if seconds > 0:
+			size = len(rows) * self.target_fetch_seconds / seconds
+		else:
+			size = self.max_batch_size
+		self.fetch_size = self.get_batch_size(self.fetch_size, size)
+
+
+	def tune_commit_size(self, batch, commit_size, write_seconds, commit_seconds):
+		"""
+
+		in the adaptive batch_mode, size the next commit from the last 
+		batch (asked for commit_size rows, taking write_seconds to convert 
+		and write, and commit_seconds to commit): aim for the commit to 
+		be self.target_commit_share of the time spent on the batch
+
+		"""
+
+		if self.batch_mode != 'adaptive' or len(batch) < commit_size:
+			return
+
+		if self.row_width is None:
+			self.row_width = self.get_row_width(batch[0])
+
+		if write_seconds > 0:
+			size = commit_seconds * len(batch) / (self.target_commit_share * write_seconds)
+		else:
+			size = self.max_batch_size
+		self.commit_size = self.get_batch_size(self.commit_size, size)
+
+
+	def gen_batches(self, rows, size, flush=None):
+		"""
+
+		group the rows coming from gen_sierra_bibs into lists of (at 
+		most) size rows. size can also be a function, returning the size 
+		of the next list, for sizes that are tuned as the batches go. 
+		flush, when it's given, is a function checked after every row, 
+		ending the list early when it returns True
+
+		"""
+
+		if callable(size):
+			get_size = size
+		else:
+			get_size = lambda: size
+
+		batch = []
+		limit = get_size()
+		for row in rows:
+			batch.append(row)
+			if len(batch) >= limit or (flush is not None and flush()):
+				yield batch
+				batch = []
+				limit = get_size()
+
+		if batch:
+			yield batch
+
+
+	#~ the bytes a fetched row is taken to be, until one has been seen
+	assumed_row_width = 2048
+
+
+	def get_rss(self):
+		"""
+
+		return the resident memory of the process, in bytes: the current 
+		one where /proc has it (linux), or else the peak so far
+
+		"""
+
+		try:
+			with open('/proc/self/statm') as statm:
+				return int(statm.read().split()[1]) * resource.getpagesize()
+		except (OSError, IndexError, ValueError):
+			return self.get_peak_rss()
+
+
+	def get_peak_rss(self):
+		#~ the peak resident memory of the process so far, in bytes 
+		#~ (ru_maxrss is in kilobytes on linux, and bytes on macos)
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		if sys.platform == 'darwin':
+			return peak
+
+		return peak * 1024
+
+
+	def check_memory(self):
+		"""
+
+		read the memory of the process, keep the peak of the run, and 
+		flag the memory pressure when it's past 80% of the budget (and 
+		has grown since the pressure was last relieved, as the memory 
+		python frees isn't always given back). Returns the memory read
+
+		"""
+
+		rss = self.get_rss()
+		self.run_peak_rss = max(self.run_peak_rss, rss)
+		if self.memory_budget and rss > max(self.memory_budget * 0.8, self.relieved_rss):
+			self.memory_pressure = True
+
+		return rss
+
+
+	def get_batches_in_flight(self):
+		"""
+
+		return the most batches of rows held in memory at once: the 
+		cursor's buffer and the rows fetched from it, the batch being 
+		written and its values, and the batches queued up by the 
+		pipeline or the parallel workers
+
+		"""
+
+		batches = 4
+		if self.pipeline == True:
+			batches += 3
+		if self.extract_mode == 'parallel':
+			batches += self.workers * 3
+
+		return batches
+
+
+	def fit_memory_budget(self):
+		"""
+
+		cap the rows in flight to half of self.memory_budget: lower 
+		self.batch_memory to its share of that, and the fetch and commit 
+		sizes to the rows of the width seen (or assumed) that fit 
+		into it
+
+		"""
+
+		self.batch_memory = min(
+			self.batch_memory, 
+			self.memory_budget / 2 / self.get_batches_in_flight()
+		)
+		rows = max(int(self.batch_memory / (self.row_width or self.assumed_row_width)), 1)
+		self.fetch_size = min(self.fetch_size, rows)
+		self.commit_size = min(self.commit_size, rows)
+
+
+	def gen_memory_checked(self, rows):
+		"""
+
+		yield the rows, fitting the batch sizes to the memory budget once 
+		the width of the first row is known, and checking the memory 
+		every self.memory_check_rows rows
+
+		"""
+
+		for i, row in enumerate(rows):
+			if i == 0:
+				self.row_width = self.get_row_width(row)
+				self.fit_memory_budget()
+				print('memory budget: \t{:.0f} MB\trows per batch: {}'.format(
+					self.memory_budget / 1024 / 1024, 
+					self.commit_size
+				))
+			elif i % self.memory_check_rows == 0:
+				self.check_memory()
+			yield row
+
+
+	def relieve_memory(self):
+		"""
+
+		after the batch cut short by the memory pressure is committed: 
+		halve the batches, release what sqlite and python can, and check 
+		the memory again. Past the budget with the batches as small as 
+		they go, the run is stopped (everything written so far having 
+		been committed) rather than left to the oom killer
+
+		"""
+
+		self.batch_memory = self.batch_memory / 2
+		self.fetch_size = self.get_batch_size(self.fetch_size, self.fetch_size / 2)
+		self.commit_size = self.get_batch_size(self.commit_size, self.commit_size / 2)
+
+		cursor = self.sqlite_conn.cursor()
+		cursor.execute("PRAGMA shrink_memory")
+		cursor.close()
+		cursor = None
+		gc.collect()
+
+		rss = self.check_memory()
+		self.relieved_rss = rss
+		self.memory_pressure = False
+		print('memory pressure: \t{:.1f} MB\tfetch size: {}\tcommit size: {}'.format(
+			rss / 1024 / 1024, 
+			self.fetch_size, 
+			self.commit_size
+		))
+		if rss > self.memory_budget and self.commit_size <= self.min_batch_size:
+			raise MemoryError('{:.1f} MB is over the memory budget of {:.0f} MB'.format(
+				rss / 1024 / 1024, 
+				self.memory_budget / 1024 / 1024
+			))
+
+
+	def write_batches(self, sql, rows, deleted=False):
+		"""
+
+		write the rows to the local database in chunks of self.commit_size, 
+		each chunk written with a single executemany inside of one 
+		explicit transaction. Rows / sec is reported for every chunk, so 
+		this can be compared against write_rows. Returns the number of 
+		rows written
+
+		"""
+
+		convert = self.get_row_converter(deleted)
+		cursor = self.sqlite_conn.cursor()
+		compact = self.get_compactor(cursor, deleted)
+
+		counter = 0
+
+		#~ (a batch is cut short when the memory nears the budget)
+		for batch in self.gen_batches(rows, lambda: self.commit_size, lambda: self.memory_pressure):
+			commit_size = self.commit_size
+			batch_start = time.perf_counter()
+			values = [convert(row) for row in batch]
+			phase_end = time.perf_counter()
+			self.add_timing('convert', phase_end - batch_start)
+			if deleted == False:
+				values = self.filter_changed(cursor, values)
+				phase_start = phase_end
+				phase_end = time.perf_counter()
+				self.add_timing('change_detection', phase_end - phase_start)
+			elif self.change_log:
+				self.find_deleted_changes(cursor, values)
+				phase_start = phase_end
+				phase_end = time.perf_counter()
+				self.add_timing('change_detection', phase_end - phase_start)
+
+			try:
+				cursor.execute('BEGIN')
+				if compact is not None:
+					#~ (any new codes go into bib_codes in the transaction 
+					#~ of the batch)
+					values = [compact(bib) for bib in values]
+				cursor.executemany(sql, values)
+				self.log_changes(cursor)
+				self.save_sync_state(cursor, batch, len(values), deleted)
+				phase_start = phase_end
+				phase_end = time.perf_counter()
+				self.add_timing('execute', phase_end - phase_start)
+				self.sqlite_conn.commit()
+				commit_seconds = time.perf_counter() - phase_end
+				self.add_timing('commit', commit_seconds)
+				self.write_change_file(deleted)
+			except sqlite3.Error as e:
+				self.sqlite_conn.rollback()
+				self.batch_changes = []
+				self.code_ids = None
+				print("unable to write batch ending with id {}: {}".format(batch[-1][self.column_index['id']], e))
+				raise
+
+			self.record_batch_metrics(len(batch), len(values))
+			if self.memory_pressure:
+				self.relieve_memory()
+			else:
+				self.tune_commit_size(batch, commit_size, phase_end - batch_start, commit_seconds)
+			elapsed = time.perf_counter() - batch_start
+			counter += len(batch)
+			print('counter: {}\tbatch rows: {}\trows/sec: {:.1f}'.format(
+				counter, 
+				len(batch), 
+				len(batch) / elapsed if elapsed > 0 else 0.0
+			))
+			print('id: {}'.format(batch[-1][self.column_index['id']]))
+
+		cursor.close()
+		cursor = None
+
+		return counter
@@ -0,0 +1,71 @@
+WITH bibs AS (
+	SELECT
+	r.id,
+	r.record_num,
+	r.record_last_updated_gmt,
+	r.creation_date_gmt,
+	r.deletion_date_gmt
+
+	FROM
+	sierra_view.record_metadata as r
+
+	WHERE
+	r.record_type_code || r.campus_code = 'b'
+	AND r.record_last_updated_gmt > to_timestamp(0)
+	AND r.deletion_date_gmt IS NULL
+)
+
+SELECT
+r.id,
+r.record_num,
+r.record_last_updated_gmt::date as record_last_update,
+extract(epoch from (r.record_last_updated_gmt)) as record_last_updated_epoch,
+r.creation_date_gmt::date,
+r.deletion_date_gmt::date,
+extract(epoch from (r.deletion_date_gmt)) as deletion_epoch,
+b.cataloging_date_gmt::date,
+p.best_title,
+p.best_author,
+p.publish_year,
+p.bib_level_code,
+p.material_code,
+b.language_code,
+b.country_code,
+c.control_num_001,
+c.control_num_035 ~* '\(ocolc\)[0-9]{6,}' as control_num_035_is_oclc,
+CASE
+	WHEN c.control_num_035 ~* '\(ocolc\)[0-9]{6,}'
+	THEN substring(c.control_num_035 from '[0-9]{6,}')
+	ELSE c.control_num_035
+END as control_num_035
+
+FROM
+bibs as r
+
+LEFT OUTER JOIN
+sierra_view.bib_record_property as p
+ON
+p.bib_record_id = r.id
+
+LEFT OUTER JOIN
+sierra_view.bib_record as b
+ON
+b.record_id = r.id
+
+-- the first o001 and o035 (by occ_num) of the bib, in one lookup of its
+-- varfields
+LEFT OUTER JOIN LATERAL (
+	SELECT
+	(array_agg(v.field_content ORDER BY v.occ_num) FILTER (WHERE v.marc_tag = '001'))[1] as control_num_001,
+	(array_agg(v.field_content ORDER BY v.occ_num) FILTER (WHERE v.marc_tag = '035'))[1] as control_num_035
+
+	FROM
+	sierra_view.varfield as v
+
+	WHERE
+	v.record_id = r.id
+	AND v.varfield_type_code = 'o'
+	AND v.marc_tag IN ('001', '035')
+) as c
+ON
+true
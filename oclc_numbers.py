@@ -0,0 +1,260 @@
+#~ this script reports the deleted bibs whose oclc number is still on a
+#~ live bib, as csv: for dedup and holdings reports, without scanning
+#~ bib_data with LIKE / substr. It uses the oclc_number column of
+#~ bib_data -- the oclc number of each bib as an integer, normalized
+#~ from control_num_035 (the digits, when control_num_035_is_oclc, or
+#~ else the raw text of the 035) -- and its index, which get_bibs
+#~ fills as it loads the bibs.
+#~
+#~ get_bibs backfills oclc_number once when it upgrades an older
+#~ local database. --backfill fills it again for every bib, reading and
+#~ normalizing ranges of the bib ids in --workers processes (the number
+#~ of cpus, unless it's given).
+#~
+#~ usage: python oclc_numbers.py [--backfill] [--workers=N] > matches.csv
+
+import array
+import configparser
+import csv
+import multiprocessing
+import os
+import re
+import sqlite3
+import sys
+import time
+
+
+#~ an oclc number in the raw text of an 035: (OCoLC) and the digits,
+#~ maybe after one of the ocm / ocn / on prefixes
+oclc_pattern = re.compile(r'\(ocolc\)\s*(?:ocm|ocn|on)?\s*([0-9]+)', re.IGNORECASE)
+
+#~ the digits that make a number that fits into sqlite's 64 bit integers
+oclc_digits = re.compile(r'[0-9]{1,18}')
+
+
+def get_oclc_number(is_oclc, control_num_035):
+	"""
+
+	return the oclc number of a bib as an integer (without its leading
+	zeros or prefix), given its control_num_035_is_oclc and
+	control_num_035, or None if it hasn't got one. This is also the
+	oclc_number() function of the local database connection, which
+	fills the column as the bibs are written
+
+	"""
+
+	if control_num_035 is None:
+		return None
+
+	if is_oclc:
+		digits = control_num_035.strip()
+	else:
+		match = oclc_pattern.search(control_num_035)
+		if match is None:
+			return None
+		digits = match.group(1)
+
+	#~ (and no number is all zeros)
+	digits = digits.lstrip('0')
+	if oclc_digits.fullmatch(digits) is None:
+		return None
+
+	return int(digits)
+
+
+def get_local_table(sqlite_conn):
+	#~ the table holding the rows of bib_data: bib_data itself, or
+	#~ bib_data_compact when bib_data is the view of the compact layout
+	cursor = sqlite_conn.cursor()
+	cursor.execute("SELECT type FROM sqlite_master WHERE name = 'bib_data'")
+	row = cursor.fetchone()
+	cursor.close()
+
+	if row is not None and row[0] == 'view':
+		return 'bib_data_compact'
+
+	return 'bib_data'
+
+
+def read_oclc_numbers(sqlite_conn, table, low, high):
+	"""
+
+	return the oclc numbers of the bibs in table with bib_ids from low
+	to high (inclusive), as a flat array of (oclc number, bib_id) pairs
+
+	"""
+
+	pairs = array.array('q')
+	cursor = sqlite_conn.cursor()
+	cursor.execute("""
+	SELECT
+	bib_id,
+	control_num_035_is_oclc,
+	control_num_035
+
+	FROM
+	{}
+
+	WHERE
+	bib_id BETWEEN ? AND ?
+	AND control_num_035 IS NOT NULL
+	""".format(table), (low, high))
+
+	for bib_id, is_oclc, control_num_035 in cursor:
+		number = get_oclc_number(is_oclc, control_num_035)
+		if number is not None:
+			pairs.append(number)
+			pairs.append(bib_id)
+
+	cursor.close()
+
+	return pairs
+
+
+def read_oclc_numbers_file(args):
+	#~ run in a worker process of the backfill, with a connection of its
+	#~ own to the local database
+	path, table, low, high = args
+	sqlite_conn = sqlite3.connect(path, timeout=60)
+	try:
+		return read_oclc_numbers(sqlite_conn, table, low, high)
+	finally:
+		sqlite_conn.close()
+
+
+def backfill_oclc_numbers(sqlite_conn, path, table='bib_data', workers=None):
+	"""
+
+	fill the oclc_number of every bib in table from its control_num_035.
+	The bib_ids are split into ranges that are read and normalized by
+	workers processes at the same time, each with a connection of its
+	own to the local database at path (a database in memory, or one
+	worker, is read on sqlite_conn). The numbers are written afterwards
+	in one transaction, as the reads and the write would otherwise lock
+	each other out -- so sqlite_conn mustn't be in a transaction. Returns
+	the number of bibs with an oclc number
+
+	"""
+
+	if workers is None:
+		workers = os.cpu_count() or 1
+
+	cursor = sqlite_conn.cursor()
+	cursor.execute("SELECT MIN(bib_id), MAX(bib_id) FROM {}".format(table))
+	min_id, max_id = cursor.fetchone()
+	if min_id is None:
+		cursor.close()
+		return 0
+
+	#~ a few ranges per worker, so an uneven spread of the ids evens out
+	width = (max_id - min_id) // (workers * 4) + 1
+	ranges = [
+		(low, min(low + width - 1, max_id))
+		for low in range(min_id, max_id + 1, width)
+	]
+
+	if workers > 1 and path not in (None, '', ':memory:'):
+		with multiprocessing.Pool(workers) as pool:
+			results = pool.map(read_oclc_numbers_file, [
+				(path, table, low, high)
+				for low, high in ranges
+			])
+	else:
+		results = [
+			read_oclc_numbers(sqlite_conn, table, low, high)
+			for low, high in ranges
+		]
+
+	try:
+		cursor.execute('BEGIN')
+		cursor.execute("UPDATE {} SET oclc_number = NULL WHERE oclc_number IS NOT NULL".format(table))
+		for pairs in results:
+			cursor.executemany(
+				"UPDATE {} SET oclc_number = ? WHERE bib_id = ?".format(table),
+				zip(pairs[0::2], pairs[1::2])
+			)
+		sqlite_conn.commit()
+
+	except sqlite3.Error as e:
+		sqlite_conn.rollback()
+		print("unable to backfill oclc_number: %s" % e)
+		raise
+
+	cursor.close()
+
+	return sum(len(pairs) for pairs in results) // 2
+
+
+#~ the deleted bibs with the live bibs sharing their oclc number: the
+#~ deleted bibs are read through the deletion_epoch index, and each
+#~ number is looked up in the oclc_number index (which covers the test
+#~ of the deletion_epoch of the live bibs). The CROSS JOIN keeps sqlite
+#~ from putting the live bibs, by far the most of them, in the outer
+#~ loop when the tables haven't been analyzed, and the + on d.bib_id
+#~ keeps it from scanning the whole table in bib_id order (rather than
+#~ sorting the few matches) to save the ORDER BY
+deleted_with_live_match_sql = """
+	SELECT
+	d.bib_id,
+	d.record_num,
+	date(d.deletion_epoch, 'unixepoch') as deletion_date,
+	d.oclc_number,
+	l.bib_id as live_bib_id,
+	l.record_num as live_record_num
+
+	FROM
+	{table} as d
+
+	CROSS JOIN
+	{table} as l
+	ON
+	  l.oclc_number = d.oclc_number
+	  AND l.deletion_epoch = 0
+
+	WHERE
+	d.deletion_epoch > 0
+	AND d.oclc_number IS NOT NULL
+
+	ORDER BY
+	+d.bib_id,
+	l.bib_id
+	"""
+
+
+def find_deleted_with_live_match(sqlite_conn):
+	"""
+
+	return the (bib_id, record_num, deletion_date, oclc_number,
+	live_bib_id, live_record_num) of each deleted bib whose oclc number
+	is still on a live bib, one row per live bib
+
+	"""
+
+	cursor = sqlite_conn.cursor()
+	cursor.execute(deleted_with_live_match_sql.format(table=get_local_table(sqlite_conn)))
+	rows = cursor.fetchall()
+	cursor.close()
+
+	return rows
+
+
+if __name__ == '__main__':
+	config = configparser.ConfigParser()
+	config.read('config.ini')
+	path = config['local_db']['connection_string']
+	sqlite_conn = sqlite3.connect(path)
+
+	if '--backfill' in sys.argv:
+		workers = None
+		for arg in sys.argv[1:]:
+			if arg.startswith('--workers='):
+				workers = int(arg[len('--workers='):])
+
+		start = time.perf_counter()
+		count = backfill_oclc_numbers(sqlite_conn, path, get_local_table(sqlite_conn), workers)
+		print('backfilled {} oclc numbers in {:.1f}s'.format(count, time.perf_counter() - start), file=sys.stderr)
+
+	writer = csv.writer(sys.stdout)
+	writer.writerow(['bib_id', 'record_num', 'deletion_date', 'oclc_number', 'live_bib_id', 'live_record_num'])
+	writer.writerows(find_deleted_with_live_match(sqlite_conn))
+	sqlite_conn.close()
@@ -0,0 +1,236 @@
+#~ this script reports the query plans of the sierra extraction, as
+#~ captured by get_bibs when explain is set in the [db] section of
+#~ config.ini: plan (EXPLAIN, which only plans the query, and so is safe
+#~ to run against production) or analyze (EXPLAIN (ANALYZE, BUFFERS),
+#~ which runs the query a second time to time it). The plan of the
+#~ exact sql and parameters of every run is kept in the sierra_plans
+#~ table of the local database, with its timings and the problems found
+#~ in it: sequential scans, estimates of the rows that are off by more
+#~ than explain_estimate_error times, and plans that changed since the
+#~ last run of the pass.
+#~
+#~ without arguments, the plans of the last 20 runs are listed (--last=N
+#~ for more); --plan=plan_id prints one of them as a tree.
+#~
+#~ usage: python query_plans.py [--last=N] [--plan=plan_id]
+
+import configparser
+import hashlib
+import json
+import sqlite3
+import sys
+
+
+def gen_plan_nodes(node, depth=0):
+	#~ yield the (depth, node) of the node of a json plan, and of the
+	#~ nodes under it, depth first
+	yield depth, node
+	for child in node.get('Plans', []):
+		yield from gen_plan_nodes(child, depth + 1)
+
+
+def get_node_name(node):
+	#~ the node type, and the relation (or index) it reads, if any
+	name = node['Node Type']
+	if 'Index Name' in node:
+		name += ' using {}'.format(node['Index Name'])
+	if 'Relation Name' in node:
+		name += ' on {}'.format(node['Relation Name'])
+		if node.get('Alias', node['Relation Name']) != node['Relation Name']:
+			name += ' {}'.format(node['Alias'])
+
+	return name
+
+
+def get_estimate_error(estimated, actual):
+	#~ how many times the estimate of the rows is off, either way (an
+	#~ estimate of 0 or 1 rows is as good as one of 1)
+	return max(estimated, actual, 1) / max(min(estimated, actual), 1)
+
+
+def summarize_plan(explained):
+	"""
+
+	return a summary of the result of an EXPLAIN (FORMAT JSON): the
+	planning and execution milliseconds, the estimated and actual rows
+	(the actual ones only with ANALYZE), the shared buffers hit and read
+	(only with BUFFERS), the nodes that scan a table sequentially, the
+	node with the worst estimate of its rows and by how many times it's
+	off, and a hash of the shape of the plan (its nodes and what they
+	read), which changes when the planner picks another plan
+
+	"""
+
+	plan = explained['Plan']
+	summary = {
+		'planning_ms': explained.get('Planning Time'),
+		'execution_ms': explained.get('Execution Time'),
+		'estimated_rows': plan.get('Plan Rows'),
+		'actual_rows': plan.get('Actual Rows'),
+		'shared_hit_blocks': plan.get('Shared Hit Blocks'),
+		'shared_read_blocks': plan.get('Shared Read Blocks'),
+		'seq_scans': [],
+		'worst_node': None,
+		'worst_estimate': None
+	}
+
+	shape = hashlib.md5()
+	for depth, node in gen_plan_nodes(plan):
+		name = get_node_name(node)
+		shape.update('{}:{}\n'.format(depth, name).encode('utf-8'))
+
+		if node['Node Type'] == 'Seq Scan':
+			summary['seq_scans'].append(node['Relation Name'])
+
+		#~ (the nodes that never ran have no actual rows to compare)
+		if 'Actual Rows' in node and node.get('Actual Loops', 1) > 0:
+			error = get_estimate_error(node['Plan Rows'], node['Actual Rows'])
+			if summary['worst_estimate'] is None or error > summary['worst_estimate']:
+				summary['worst_estimate'] = error
+				summary['worst_node'] = name
+
+	summary['plan_shape'] = shape.hexdigest()
+
+	return summary
+
+
+def get_plan_flags(summary, previous, estimate_error):
+	"""
+
+	return the problems found in a plan summary (with the actual rows
+	filled in), as a list of strings: its sequential scans, an estimate
+	of the rows off by estimate_error times or more, and the changes
+	from previous -- the (run_id, plan_shape, execution_ms) of the last
+	plan of the pass, or None
+
+	"""
+
+	flags = ['seq scan on {}'.format(relation) for relation in summary['seq_scans']]
+
+	if summary['worst_estimate'] is not None and summary['worst_estimate'] >= estimate_error:
+		flags.append('rows estimate off {:.0f}x at {}'.format(summary['worst_estimate'], summary['worst_node']))
+
+	if previous is not None:
+		previous_run_id, previous_shape, previous_execution_ms = previous
+		if previous_shape != summary['plan_shape']:
+			flags.append('plan changed since run {}'.format(previous_run_id))
+
+		#~ (a slower run of the same plan is down to the data, or the load
+		#~ on the server; it's worth knowing about either way)
+		if previous_execution_ms and summary['execution_ms'] and summary['execution_ms'] >= previous_execution_ms * 2:
+			flags.append('execution {:.1f}x slower than run {}'.format(
+				summary['execution_ms'] / previous_execution_ms,
+				previous_run_id
+			))
+
+	return flags
+
+
+def format_plan(explained):
+	#~ the json plan as an indented tree, with the estimated (and the
+	#~ actual) rows of each node
+	lines = []
+	for depth, node in gen_plan_nodes(explained['Plan']):
+		line = '{}{}  (rows={}'.format('  ' * depth + ('-> ' if depth else ''), get_node_name(node), node.get('Plan Rows'))
+		if 'Actual Rows' in node:
+			line += ' actual={} loops={} time={}ms'.format(
+				node['Actual Rows'],
+				node.get('Actual Loops'),
+				node.get('Actual Total Time')
+			)
+		lines.append(line + ')')
+		for key in ('Index Cond', 'Hash Cond', 'Merge Cond', 'Filter'):
+			if key in node:
+				lines.append('{}   {}: {}'.format('  ' * depth, key, node[key]))
+
+	for key in ('Planning Time', 'Execution Time'):
+		if key in explained:
+			lines.append('{}: {}ms'.format(key, explained[key]))
+
+	return '\n'.join(lines)
+
+
+def print_plans(sqlite_conn, last):
+	cursor = sqlite_conn.cursor()
+	cursor.execute("""
+	SELECT
+	p.plan_id,
+	p.run_id,
+	p.sync_name,
+	p.captured,
+	p.explain_mode,
+	p.estimated_rows,
+	p.actual_rows,
+	p.planning_ms,
+	p.execution_ms,
+	r.seconds,
+	p.flags
+
+	FROM
+	sierra_plans as p
+
+	LEFT OUTER JOIN
+	sync_runs as r
+	ON
+	  r.run_id = p.run_id
+
+	ORDER BY
+	p.plan_id DESC
+
+	LIMIT ?
+	""", (last, ))
+	plans = cursor.fetchall()
+	cursor.close()
+
+	print('{:>6}{:>6}  {:<9}{:<21}{:<9}{:>10}{:>10}{:>10}{:>12}{:>9}  {}'.format(
+		'plan', 'run', 'pass', 'captured', 'explain', 'est rows', 'rows', 'plan ms', 'exec ms', 'run s', 'flags'
+	))
+	for plan_id, run_id, sync_name, captured, explain_mode, estimated_rows, actual_rows, planning_ms, execution_ms, seconds, flags in reversed(plans):
+		print('{:>6}{:>6}  {:<9}{:<21}{:<9}{:>10}{:>10}{:>10}{:>12}{:>9}  {}'.format(
+			plan_id,
+			run_id,
+			sync_name,
+			captured[:19],
+			explain_mode,
+			'' if estimated_rows is None else '{:.0f}'.format(estimated_rows),
+			'' if actual_rows is None else actual_rows,
+			'' if planning_ms is None else '{:.1f}'.format(planning_ms),
+			'' if execution_ms is None else '{:.1f}'.format(execution_ms),
+			'' if seconds is None else '{:.1f}'.format(seconds),
+			flags
+		))
+
+
+def print_plan(sqlite_conn, plan_id):
+	cursor = sqlite_conn.cursor()
+	cursor.execute("SELECT sql, params, plan FROM sierra_plans WHERE plan_id = ?", (plan_id, ))
+	row = cursor.fetchone()
+	cursor.close()
+	if row is None:
+		sys.exit('no plan {}'.format(plan_id))
+
+	sql, params, plan = row
+	print(sql.strip())
+	print('params: {}'.format(params))
+	print('')
+	print(format_plan(json.loads(plan)))
+
+
+if __name__ == '__main__':
+	config = configparser.ConfigParser()
+	config.read('config.ini')
+	sqlite_conn = sqlite3.connect(config['local_db']['connection_string'])
+
+	last = 20
+	plan_id = None
+	for arg in sys.argv[1:]:
+		if arg.startswith('--last='):
+			last = int(arg[len('--last='):])
+		elif arg.startswith('--plan='):
+			plan_id = int(arg[len('--plan='):])
+
+	if plan_id is not None:
+		print_plan(sqlite_conn, plan_id)
+	else:
+		print_plans(sqlite_conn, last)
+	sqlite_conn.close()
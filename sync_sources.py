@@ -0,0 +1,192 @@
+#~ this script syncs several sierra instances (the member libraries of a
+#~ consortium, say) at the same time, rather than one after another. Each
+#~ source is a config file of its own, laid out like config.ini, and its
+#~ sync -- both passes, and the export -- runs on a thread of its own,
+#~ started from an asyncio loop. The syncs spend most of their time
+#~ waiting on the network (and in sqlite), both of which let the other
+#~ threads run, so the whole sync takes about as long as the slowest
+#~ source rather than the sum of them.
+#~
+#~ every source writes into its own local database (the [local_db]
+#~ connection_string of its config), which have to be different files:
+#~ sqlite takes one writer at a time, and the bib ids of different
+#~ sierra instances overlap. The same goes for the rest of what a sync
+#~ writes -- the export, the ndjson change logs and the metrics files
+#~ -- none of which say which source they came from.
+#~
+#~ the lines each source prints are prefixed with its name (the name of
+#~ its config file), and the time of each is reported at the end.
+#~
+#~ usage: python sync_sources.py [--jobs=N] config_a.ini config_b.ini ...
+
+import asyncio
+import concurrent.futures
+import configparser
+import os
+import sys
+import threading
+import time
+import traceback
+
+import get_bibs
+
+
+class SourceOutput:
+	"""
+
+	stands in for sys.stdout while the sources sync: each line printed
+	is prefixed with the name of the thread (so, the source) printing it
+
+	"""
+
+	def __init__(self, stream):
+		self.stream = stream
+		self.lock = threading.Lock()
+		#~ the unfinished line of each thread
+		self.partial = {}
+
+
+	def write(self, text):
+		name = threading.current_thread().name
+		with self.lock:
+			lines = (self.partial.pop(name, '') + text).split('\n')
+			if lines[-1]:
+				self.partial[name] = lines[-1]
+			for line in lines[:-1]:
+				self.stream.write('[{}] {}\n'.format(name, line))
+
+		return len(text)
+
+
+	def flush(self):
+		with self.lock:
+			for name, line in self.partial.items():
+				self.stream.write('[{}] {}\n'.format(name, line))
+			self.partial = {}
+			self.stream.flush()
+
+
+def get_outputs(config):
+	"""
+
+	return the (description, absolute path) of each of the files and 
+	directories the sync of a source writes to
+
+	"""
+
+	outputs = [('local database', config['local_db']['connection_string'])]
+	if 'ndjson' in config['local_db'].get('change_log', 'none'):
+		outputs.append(('changes_dir', config['local_db'].get('changes_dir', 'changes')))
+	if 'export' in config:
+		outputs.append(('export path', config['export'].get('path', '')))
+	if 'metrics' in config:
+		outputs.append(('metrics json_file', config['metrics'].get('json_file', '')))
+		outputs.append(('metrics prometheus_file', config['metrics'].get('prometheus_file', '')))
+
+	#~ ('' is for none)
+	return [(description, os.path.abspath(path)) for description, path in outputs if path]
+
+
+def get_sources(paths):
+	"""
+
+	return the (name, config) of each of the config files in paths, 
+	none of which may write to the same file (or directory) as another
+
+	"""
+
+	sources = []
+	outputs = set()
+	for path in paths:
+		config = configparser.ConfigParser()
+		if not config.read(path):
+			sys.exit('unable to read {}'.format(path))
+
+		for description, output in get_outputs(config):
+			if output in outputs:
+				sys.exit('{} writes its {} to the same place as another source: {}'.format(path, description, output))
+			outputs.add(output)
+
+		sources.append((os.path.splitext(os.path.basename(path))[0], config))
+
+	return sources
+
+
+def sync_source(name, config):
+	"""
+
+	run on a thread of the runner: open a session of the App of one
+	source, and sync it (the session is closed on this thread, where
+	the local database was opened). Returns the seconds it took
+
+	"""
+
+	threading.current_thread().name = name
+	start = time.perf_counter()
+	try:
+		with get_bibs.App(config) as app:
+			app.sync()
+	except Exception:
+		traceback.print_exc(file=sys.stdout)
+		raise
+
+	return time.perf_counter() - start
+
+
+async def sync_sources(sources, jobs):
+	"""
+
+	sync the sources, at most jobs of them at the same time. Returns
+	the seconds each took (or the exception it failed with), in the
+	order of the sources
+
+	"""
+
+	loop = asyncio.get_running_loop()
+	with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+		syncs = [
+			loop.run_in_executor(executor, sync_source, name, config)
+			for name, config in sources
+		]
+		results = await asyncio.gather(*syncs, return_exceptions=True)
+
+	return results
+
+
+if __name__ == '__main__':
+	paths = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+	if not paths:
+		sys.exit('usage: python sync_sources.py [--jobs=N] config_a.ini config_b.ini ...')
+
+	sources = get_sources(paths)
+	jobs = len(sources)
+	for arg in sys.argv[1:]:
+		if arg.startswith('--jobs='):
+			jobs = int(arg[len('--jobs='):])
+
+	stdout = sys.stdout
+	sys.stdout = SourceOutput(stdout)
+	start = time.perf_counter()
+	try:
+		results = asyncio.run(sync_sources(sources, jobs))
+	finally:
+		sys.stdout.flush()
+		sys.stdout = stdout
+	elapsed = time.perf_counter() - start
+
+	print('')
+	print('{:<24}{:>12}'.format('source', 'seconds'))
+	failed = 0
+	for (name, config), result in zip(sources, results):
+		if isinstance(result, BaseException):
+			failed += 1
+			print('{:<24}{:>12}  {}'.format(name, 'failed', result))
+		else:
+			print('{:<24}{:>12.1f}'.format(name, result))
+	print('{:<24}{:>12.1f}'.format('sum of the sources', sum(
+		result for result in results if not isinstance(result, BaseException)
+	)))
+	print('{:<24}{:>12.1f}'.format('wall time', elapsed))
+
+	if failed:
+		sys.exit(1)